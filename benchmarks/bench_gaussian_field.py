@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Compare the gstools and FFT circulant embedding velocity fields on the
+mesh of the 3D examples (40 x 50 x 30 cells).
+
+    python bench_gaussian_field.py
+
+"""
+
+import sys
+sys.path.append('../')
+import time
+import numpy as np
+from shpmc.geo_stats import GaussianField, SpectralGaussianField
+
+n_draws = 20
+
+x = np.arange(40) + 0.5
+y = np.arange(50) + 0.5
+z = np.arange(30) + 0.5
+
+params = dict(
+    mean = [0, 0],
+    variance = [1, 1],
+    range_x = [2, 20], 
+    range_y = [2, 20], 
+    range_z = [2, 10], 
+    anisotropy_xy = [0, 180],
+    anisotropy_xz = [0, 180],
+    x = x, 
+    y = y, 
+    z = z,
+    random = True,
+    output_params = True,
+    )
+
+fields = {
+    'gstools': GaussianField(**params),
+    'spectral': SpectralGaussianField(**params),
+    }
+
+for name, gf in fields.items():
+    
+    t0 = time.perf_counter()
+    for _ in range(n_draws):
+        field, theta = gf.field_3d
+    t = (time.perf_counter() - t0) / n_draws
+    
+    print('{:<24s} {:8.4f} s/field'.format(name, t))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Benchmark the hot paths of the sampler on synthetic grids, from the mesh of
+the 3D examples (40 x 50 x 30 cells) up to 256^3, and write the timings and
+peak memory as JSON to compare runs, e.g., before and after an upgrade of
+gstools or scikit-fmm.
+
+    python bench_sampler.py --sizes 40x50x30 64x64x64 128x128x128 256x256x256 --field spectral
+
+The gstools fields take minutes per draw on the largest grids, use
+'--field spectral' there.
+
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import scipy
+import gstools
+import skfmm
+from shpmc.geo_stats import GaussianField, SpectralGaussianField
+from shpmc.level_set_mc import StochasticLevelSet3D, level_set_perturbation, signed_distance
+from shpmc.loss_functions import loss_ordinary_procrustes_analysis
+from synthetic import synthetic_intrusion
+
+
+
+def measure(func, repeat):
+    """
+
+    Wall-clock times of 'repeat' calls, and the peak memory allocated by one extra call
+
+    """
+
+    func()
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'mean': float(np.mean(times)),
+        'min': float(np.min(times)),
+        'std': float(np.std(times)),
+        'times': times,
+        'peak_memory_mb': peak / 2**20,
+        }
+
+
+
+def bench_size(shape, field, repeat, iterations, seed, dtype = 'float64'):
+
+    np.random.seed(seed)
+    data = synthetic_intrusion(shape, seed=seed)
+
+    if field == 'spectral':
+        gf = SpectralGaussianField(**data['field_params'], dtype=dtype)
+    else:
+        gf = GaussianField(**data['field_params'], dtype=dtype)
+
+    L = StochasticLevelSet3D(
+        [data['drillholes'], data['outcrops'], data['sketch']],
+        [data['initial']],
+        gaussian_field = gf,
+        max_step = 1,
+        contribution = [1, 1, 1],
+        dtype = dtype,
+        )
+
+    model_sign_dist = signed_distance(data['initial'].astype(dtype))
+    velocity_field, _ = gf.field_3d
+
+    # Inside cells of the sketch cross-section, as compared by the sketch loss
+    sketch_reference, ind_, _ = data['sketch']
+    k, i = np.nonzero(model_sign_dist[:, ind_, :].T > 0)
+    shape_comparision = np.stack((i, k), 1).astype(float)
+
+    stages = {
+        'field_3d': lambda: gf.field_3d,
+        'level_set_perturbation': lambda: level_set_perturbation(model_sign_dist, velocity_field, 1, workspace=L._workspace),
+        'loss_computation': lambda: L.loss_computation(model_sign_dist),
+        'loss_ordinary_procrustes_analysis': lambda: loss_ordinary_procrustes_analysis(
+            sketch_reference.copy(), shape_comparision.copy(), 1),
+        }
+
+    results = {'shape': list(shape), 'n_cells': int(np.prod(shape)), 'field': field, 'dtype': dtype, 'stages': {}}
+
+    for name, func in stages.items():
+        results['stages'][name] = measure(func, repeat)
+        print('{:>14s} {:<36s} {:10.4f} s'.format('x'.join(map(str, shape)), name, results['stages'][name]['mean']))
+
+    # Full iterations, without storing the models
+    run = lambda: L.mcmc_sampling_single_chain(iterations + 1, temperature=20, progress=False, store_models=False)
+    results['stages']['iteration'] = measure(run, 1)
+    results['iterations_per_second'] = iterations / results['stages']['iteration']['mean']
+    print('{:>14s} {:<36s} {:10.2f} it/s'.format('x'.join(map(str, shape)), 'iterations', results['iterations_per_second']))
+
+    return results
+
+
+
+def metadata():
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'gstools': gstools.__version__,
+        'scikit-fmm': getattr(skfmm, '__version__', ''),
+        }
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the sampler hot paths.')
+    parser.add_argument('--sizes', nargs='+', default=['40x50x30', '64x64x64', '128x128x128'],
+                        help='grid sizes, e.g., 40x50x30 256x256x256')
+    parser.add_argument('--field', choices=['gstools', 'spectral'], default='gstools',
+                        help='velocity field generator')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help='floating point type of the fields and models')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls of each stage')
+    parser.add_argument('--iterations', type=int, default=20, help='iterations of the full sampler')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_sampler.json', help='JSON file of the results')
+    args = parser.parse_args()
+
+    results = {'meta': metadata(), 'args': vars(args), 'results': []}
+
+    for size in args.sizes:
+        shape = tuple(int(ele) for ele in size.lower().split('x'))
+        results['results'].append(bench_size(shape, args.field, args.repeat, args.iterations, args.seed, args.dtype))
+
+    # Peak resident memory of the whole run (kilobytes on Linux)
+    results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print('Results written to', args.output)
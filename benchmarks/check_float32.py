@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Check that the float32 mode gives the posterior maps of the float64 mode.
+
+Both chains run from the same seed on a synthetic intrusion. The float32
+rounding only changes borderline acceptance decisions, so the probability
+and signed distance maps must agree within the tolerances; the exit status
+is 1 otherwise. The timings and peak model memory are reported as well.
+
+    python check_float32.py --shape 40x50x30 --iterations 500
+
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import time
+import numpy as np
+from shpmc.geo_stats import GaussianField, SpectralGaussianField
+from shpmc.level_set_mc import StochasticLevelSet3D
+from synthetic import synthetic_intrusion
+
+
+
+def run(data, dtype, field, iterations, burn_in, seed):
+
+    np.random.seed(seed)
+
+    if field == 'spectral':
+        gf = SpectralGaussianField(**data['field_params'], dtype=dtype)
+    else:
+        gf = GaussianField(**data['field_params'], dtype=dtype)
+
+    L = StochasticLevelSet3D(
+        [data['drillholes'], data['outcrops'], data['sketch']],
+        [data['initial']],
+        gaussian_field = gf,
+        max_step = 1,
+        contribution = [1, 1, 1],
+        dtype = dtype,
+        )
+
+    t0 = time.perf_counter()
+    loss_values, sample_models, acceptance_count, summary = L.mcmc_sampling_single_chain(
+        iterations, temperature=20, progress=False, burn_in=burn_in, output_summary=True)
+
+    return loss_values, sample_models, acceptance_count, summary['posterior'], time.perf_counter() - t0
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare the float32 and float64 posterior maps.')
+    parser.add_argument('--shape', default='24x30x18', help='grid size, e.g., 40x50x30')
+    parser.add_argument('--field', choices=['gstools', 'spectral'], default='spectral')
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--burn-in', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tol-probability', type=float, default=0.05,
+                        help='tolerance of the mean absolute difference of the target probability')
+    parser.add_argument('--tol-mean', type=float, default=0.05,
+                        help='tolerance of the mean absolute difference of the mean signed distance (cells)')
+    args = parser.parse_args()
+
+    shape = tuple(int(ele) for ele in args.shape.lower().split('x'))
+    data = synthetic_intrusion(shape, seed=args.seed)
+
+    outputs = {}
+    for dtype in [np.float64, np.float32]:
+        outputs[np.dtype(dtype).name] = run(data, dtype, args.field, args.iterations, args.burn_in, args.seed)
+
+    loss_64, models_64, acc_64, post_64, t_64 = outputs['float64']
+    loss_32, models_32, acc_32, post_32, t_32 = outputs['float32']
+
+    diff_probability = np.abs(post_32.probability - post_64.probability)
+    diff_mean = np.abs(post_32.mean - post_64.mean)
+    same_loss = np.mean(np.isclose(loss_32.sum(1), loss_64.sum(1), rtol=1e-4))
+
+    print('{:<40s} {:>12s} {:>12s}'.format('', 'float64', 'float32'))
+    print('{:<40s} {:12.2f} {:12.2f}'.format('time (s)', t_64, t_32))
+    print('{:<40s} {:12.1f} {:12.1f}'.format('stored models (MB)', models_64.nbytes / 2**20, models_32.nbytes / 2**20))
+    print('{:<40s} {:12d} {:12d}'.format('accepted', acc_64, acc_32))
+    print('{:<40s} {:12.4f}'.format('iterations with the same loss', same_loss))
+    print('{:<40s} {:12.4f} (max {:.4f})'.format('probability, mean abs. difference', diff_probability.mean(), diff_probability.max()))
+    print('{:<40s} {:12.4f} (max {:.4f})'.format('signed distance, mean abs. difference', diff_mean.mean(), diff_mean.max()))
+
+    passed = diff_probability.mean() <= args.tol_probability and diff_mean.mean() <= args.tol_mean
+    print('PASSED' if passed else 'FAILED')
+
+    sys.exit(0 if passed else 1)
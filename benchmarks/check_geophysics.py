@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Check the coarsening of the gravity constraint with and without active cells.
+
+A model made of whole coarse blocks has the same response on the fine and
+on the coarse grid, and a constraint without active cells requires the
+shape of the model grid. The exit status is 1 otherwise.
+
+    python check_geophysics.py --shape 20x24x12 --factor 2
+
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import numpy as np
+from discretize import TensorMesh
+from shpmc.geophysics import gravity_sensitivity, GeophysicsConstraint
+from shpmc.multiresolution import coarse_shape
+
+
+
+def check_coarsen(mesh, receivers, shape, factor, active, rng):
+
+    G = gravity_sensitivity(mesh, receivers, active=active)
+    constraint = GeophysicsConstraint(G, np.zeros(len(receivers)), contrast=0.3, active=active)
+
+    # Model of whole coarse blocks
+    shape_coarse = coarse_shape(shape, factor)
+    model_coarse = rng.normal(size=shape_coarse)
+    model = np.kron(model_coarse, np.ones((factor,) * 3))[tuple(slice(0, n) for n in shape)]
+
+    coarse = constraint.coarsen(factor, shape)
+    response = constraint.forward(model)
+    response_coarse = coarse.forward(model_coarse)
+
+    error = np.abs(response - response_coarse).max() / np.abs(response).max()
+    print('{:<40s} {:12.2e}'.format('coarse response, {} active'.format('all' if active is None else 'masked'), error))
+
+    return error < 1e-4
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the coarsening of the gravity constraint.')
+    parser.add_argument('--shape', default='20x24x12', help='grid size, e.g., 40x50x30')
+    parser.add_argument('--factor', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    shape = tuple(int(ele) for ele in args.shape.lower().split('x'))
+    rng = np.random.default_rng(args.seed)
+
+    mesh = TensorMesh([np.full(n, 10.) for n in shape], origin=[0, 0, -10. * shape[2]])
+
+    x, y = np.meshgrid(mesh.cell_centers_x, mesh.cell_centers_y, indexing='ij')
+    receivers = np.c_[x.ravel(), y.ravel(), np.full(x.size, 1.)]
+
+    # Topography: the top layer is inactive in half of the grid
+    active = np.ones(shape, dtype=bool)
+    active[:shape[0] // 2, :, -1] = False
+
+    passed = check_coarsen(mesh, receivers, shape, args.factor, None, rng)
+    passed &= check_coarsen(mesh, receivers, shape, args.factor, active, rng)
+
+    # The shape is required without active cells
+    constraint = GeophysicsConstraint(gravity_sensitivity(mesh, receivers), np.zeros(len(receivers)))
+    try:
+        constraint.coarsen(args.factor)
+        required = False
+    except ValueError:
+        required = True
+    print('{:<40s} {}'.format('shape required without active cells', required))
+
+    passed &= required
+    print('PASSED' if passed else 'FAILED')
+
+    sys.exit(0 if passed else 1)
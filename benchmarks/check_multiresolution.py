@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Check the coarse-to-fine sampler with the spectral gaussian field on grids
+that do not divide evenly by the coarsening factors.
+
+The coarse cell centres must stay regular, so the spectral field runs on
+every level, and an irregular grid must fall back to the gstools field.
+The exit status is 1 otherwise.
+
+    python check_multiresolution.py --shape 40x50x30 --levels 4,2
+
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import numpy as np
+from shpmc.geo_stats import GaussianField, SpectralGaussianField
+from shpmc.level_set_mc import StochasticLevelSet3D
+from shpmc.multiresolution import coarse_shape, coarsen_field
+from synthetic import synthetic_intrusion
+
+
+
+def check_centres(gf, shape, factors):
+
+    passed = True
+
+    for factor in factors:
+        coarse = coarsen_field(gf, factor)
+        regular = isinstance(coarse, SpectralGaussianField)
+        for ele, n in zip((coarse.x, coarse.y, coarse.z), coarse_shape(shape, factor)):
+            regular &= len(ele) == n and np.allclose(np.diff(ele), factor * (gf.x[1] - gf.x[0]))
+        print('{:<40s} {}'.format('regular centres, factor {}'.format(factor), regular))
+        passed &= regular
+
+    # Irregular centres fall back to the gstools field
+    params = {key: getattr(gf, key) for key in (
+        'mean', 'variance', 'range_x', 'range_y', 'range_z', 'anisotropy_xy', 'anisotropy_xz', 'y', 'z')}
+    irregular = SpectralGaussianField(**params, x=gf.x**1.1, random=True, output_params=True)
+    coarse = coarsen_field(irregular, factors[0])
+    fallback = type(coarse) is GaussianField and len(coarse.x) == coarse_shape(shape, factors[0])[0]
+    print('{:<40s} {}'.format('irregular centres fall back to gstools', fallback))
+
+    return passed and fallback
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the multiresolution sampler on non-divisible grids.')
+    parser.add_argument('--shape', default='40x50x30', help='grid size, e.g., 40x50x30')
+    parser.add_argument('--levels', default='4,2', help='coarsening factors, from the coarsest one')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    shape = tuple(int(ele) for ele in args.shape.lower().split('x'))
+    factors = [int(ele) for ele in args.levels.split(',')]
+    data = synthetic_intrusion(shape, seed=args.seed)
+
+    np.random.seed(args.seed)
+    gf = SpectralGaussianField(**data['field_params'])
+
+    passed = check_centres(gf, shape, factors)
+
+    L = StochasticLevelSet3D(
+        [data['drillholes'], data['outcrops'], data['sketch']],
+        [data['initial']],
+        gaussian_field = gf,
+        max_step = 1,
+        contribution = [1, 1, 1],
+        )
+
+    loss_values, sample_models, acceptance_count, summary = L.mcmc_sampling_multiresolution(
+        args.iterations, [(ele, args.iterations) for ele in factors],
+        temperature = 20, progress = False, output_summary = True)
+
+    finite = np.all(np.isfinite(loss_values)) and all(np.all(np.isfinite(ele['loss_values'])) for ele in summary['levels'])
+    print('{:<40s} {}'.format('sampled all levels', finite))
+    for ele in summary['levels']:
+        print('{:<40s} {:12.4f}'.format('last loss, factor {}'.format(ele['factor']), ele['loss_values'][-1].sum()))
+    print('{:<40s} {:12.4f}'.format('last loss, model grid', loss_values[-1].sum()))
+
+    passed &= finite
+    print('PASSED' if passed else 'FAILED')
+
+    sys.exit(0 if passed else 1)
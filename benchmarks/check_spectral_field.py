@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Check that the spectral gaussian field samples the prior of GaussianField.
+
+The range and anisotropy parameters of the random fields must follow their
+continuous uniform priors (Kolmogorov-Smirnov test), and the fields must
+have the covariance of the gstools model: the embedded covariance of random
+parameters is compared with the model, and the mean sample variance of the
+fields with the prior variance. The exit status is 1 otherwise.
+
+    python check_spectral_field.py --draws 200
+
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import numpy as np
+import gstools as gs
+from scipy import fft, stats
+from shpmc.geo_stats import SpectralGaussianField
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the parameter and covariance prior of the spectral field.')
+    parser.add_argument('--shape', default='40x50x30', help='grid size, e.g., 40x50x30')
+    parser.add_argument('--draws', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=0.001, help='significance level of the KS tests')
+    parser.add_argument('--tol-cov', type=float, default=0.01, help='tolerance of the embedded covariance')
+    args = parser.parse_args()
+
+    shape = tuple(int(ele) for ele in args.shape.lower().split('x'))
+    x, y, z = [np.arange(n) + 0.5 for n in shape]
+
+    params = dict(
+        mean = [0, 0],
+        variance = [1, 1],
+        range_x = [2, shape[0] / 2],
+        range_y = [2, shape[1] / 2],
+        range_z = [2, shape[2] / 3],
+        anisotropy_xy = [0, 180],
+        anisotropy_xz = [0, 180],
+        x = x,
+        y = y,
+        z = z,
+        random = True,
+        output_params = True,
+        )
+
+    np.random.seed(args.seed)
+    gf = SpectralGaussianField(**params)
+
+    thetas, variances = [], []
+    for _ in range(args.draws):
+        field, theta = gf.field_3d
+        thetas.append(theta)
+        variances.append(field.var())
+    thetas = np.array(thetas)
+
+    passed = True
+
+    # Parameters against their continuous priors
+    names = ['range_x', 'range_y', 'range_z', 'anisotropy_xy', 'anisotropy_xz']
+    for count, name in enumerate(names):
+        low, high = params[name]
+        p_value = stats.kstest(thetas[:, count+2], stats.uniform(low, high - low).cdf).pvalue
+        n_unique = len(np.unique(thetas[:, count+2]))
+        print('{:<40s} p = {:.3f}, {} distinct values'.format(name, p_value, n_unique))
+        passed &= p_value > args.alpha and n_unique == args.draws
+
+    # Embedded covariance against the gstools model for some of the draws
+    error = 0
+    for theta in thetas[:5]:
+        sqrt_lambda = gf._spectrum(theta, [gf.range_x, gf.range_y, gf.range_z], [x, y, z]).astype(float)
+
+        lags = [np.fft.fftfreq(n, 1./n) for n in sqrt_lambda.shape]
+        lags = np.array([ele.ravel() for ele in np.meshgrid(*lags, indexing='ij')])
+
+        model = gs.Gaussian(dim=3, var=1., len_scale=list(theta[2:5]), angles=list(theta[5:7] * np.pi/180))
+        cov = fft.ifftn(sqrt_lambda**2 * sqrt_lambda.size).real
+
+        error = max(error, np.abs(cov - model.cov_spatial(lags).reshape(cov.shape)).max())
+
+    print('{:<40s} {:12.2e}'.format('embedded covariance, max. error', error))
+    passed &= error < args.tol_cov
+
+    # The sample variance of a field is below the prior variance for long ranges
+    print('{:<40s} {:12.4f}'.format('mean sample variance of the fields', np.mean(variances)))
+    passed &= 0.3 < np.mean(variances) <= 1.05
+
+    print('PASSED' if passed else 'FAILED')
+
+    sys.exit(0 if passed else 1)
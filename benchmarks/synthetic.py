@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Synthetic intrusion with drillhole, outcrop and sketch constraints on a
+regular grid of any size, for benchmarks and tests of the sampler.
+
+"""
+
+import numpy as np
+
+
+
+def synthetic_intrusion(shape = (40, 50, 30), n_holes = 8, outcrop_fraction = 0.1, seed = 0):
+    """
+
+    Ellipsoidal intrusion with a wavy boundary and its observations.
+
+    Parameters
+    ----------
+    shape : tuple, default: (40, 50, 30)
+        number of cells in x, y and z (z increasing upward)
+    n_holes : int, default: 8
+        number of vertical drillholes at random columns
+    outcrop_fraction : float, default: 0.1
+        fraction of the top cells observed as outcrops
+    seed : int, default: 0
+        seed of the random drillhole and outcrop locations
+
+    Returns
+    -------
+    dict
+        'truth' : indicator of the intrusion
+        'drillholes', 'outcrops' : observations on the grid, 0, 1 and 0.5 for non-target,
+        target and contact cells and NaN elsewhere. The outcrops include the contact of
+        the intrusion on the top layer.
+        'sketch' : [shape_reference, ind_, 'y'], cell indices (x, z) of the intrusion in
+        the middle y cross-section in the order used by SketchConstraint
+        'initial' : initial level set, a smaller ellipsoid
+        'field_params' : parameters of GaussianField with ranges scaled to the grid
+
+    """
+
+    rng = np.random.default_rng(seed)
+    shape = tuple(shape)
+    nx, ny, nz = shape
+
+    x, y, z = [np.arange(n) + 0.5 for n in shape]
+    X, Y, Z = np.meshgrid(x / nx, y / ny, z / nz, indexing='ij')
+
+    # Intrusion reaching the top of the grid
+    r = np.sqrt(((X - 0.5) / 0.3)**2 + ((Y - 0.5) / 0.35)**2 + ((Z - 0.6) / 0.45)**2)
+    r += 0.08 * np.sin(6 * np.pi * X) * np.sin(4 * np.pi * Y)
+    truth = (r < 1).astype(float)
+
+    # Vertical drillholes, contacts where the lithology changes
+    drillholes = np.full(shape, np.nan)
+    columns = rng.choice(nx * ny, size=min(n_holes, nx * ny), replace=False)
+
+    for i, j in zip(*np.unravel_index(columns, (nx, ny))):
+        drillholes[i, j, :] = truth[i, j, :]
+        drillholes[i, j, np.flatnonzero(np.diff(truth[i, j, :]) != 0)] = 0.5
+
+    # Outcrops on the top layer and the mapped contact of the intrusion
+    outcrops = np.full(shape, np.nan)
+    top = rng.random((nx, ny)) < outcrop_fraction
+    outcrops[:, :, -1][top] = truth[:, :, -1][top]
+
+    footprint = truth[:, :, -1] > 0
+    padded = np.pad(footprint, 1, mode='edge')
+    contact = footprint & ~(padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:])
+    outcrops[:, :, -1][contact] = 0.5
+
+    # Sketch of the middle y cross-section, first index varying fastest
+    ind_ = ny // 2
+    k, i = np.nonzero(truth[:, ind_, :].T)
+    sketch = [np.stack((i, k), 1).astype(float), ind_, 'y']
+
+    initial = (r < 0.7).astype(float) - 0.5
+
+    field_params = dict(
+        mean = [0, 0],
+        variance = [1, 1],
+        range_x = [2, max(nx / 2, 3)],
+        range_y = [2, max(ny / 2, 3)],
+        range_z = [2, max(nz / 3, 3)],
+        anisotropy_xy = [0, 180],
+        anisotropy_xz = [0, 180],
+        x = x,
+        y = y,
+        z = z,
+        random = True,
+        output_params = True,
+        )
+
+    return {
+        'truth': truth,
+        'drillholes': drillholes,
+        'outcrops': outcrops,
+        'sketch': sketch,
+        'initial': initial,
+        'field_params': field_params,
+        }
+
@@ -15,23 +15,13 @@ path_o = './outputs/'
 mesh = TensorMesh._readUBC_3DMesh(path_i + 'mesh.txt')
 
 hf = h5py.File(path_o + 'output_sampling_chain_1.h5', 'r')
-model_array = np.array(hf.get('model_dist'))
 loss = np.array(hf.get('loss'))
-hf.close()
-
-cut_off = 500
-independence = -1*np.arange(0, cut_off, 2)
-model_array_cut = model_array[independence, :, :, :]
-
-n = model_array_cut.shape[0]
-model_1d = np.zeros([mesh.nC, n])
 
-for i in range(n):
-    m_dist_1d = np.reshape(model_array_cut[i, :, :, :], -1, order="F")
-    m = np.zeros_like(m_dist_1d)
-    m[np.where(m_dist_1d >= 0)[0]] = 1
-    model_1d[:, i] = m
+# Posterior maps computed during sampling (after burn-in and thinning)
+model_mean = np.array(hf.get('posterior/probability'))
+model_std = np.array(hf.get('posterior/indicator_std'))
+hf.close()
 
-np.savetxt(path_o + 'output_model_unique_1d.txt', model_1d)
+np.savetxt(path_o + 'output_model_mean_1d.txt', model_mean.reshape(-1, order="F"))
+np.savetxt(path_o + 'output_model_std_1d.txt', model_std.reshape(-1, order="F"))
 np.savetxt(path_o + 'output_loss.txt', loss)
-
@@ -14,14 +14,12 @@ path_o = './outputs/'
 mesh = TensorMesh._readUBC_3DMesh(path_i + 'mesh.txt')
 ind_active = np.loadtxt(path_i + 'ind_active.txt', dtype=bool)
 
-# Compute mean and std models
+# Mean and std models
 # For visualization, please refer to examples/02-drillholes-outcrops-3d
-model = np.loadtxt(path_o + 'output_model_unique_1d.txt')
-
-model_std = np.std(model, axis=-1)
+model_std = np.loadtxt(path_o + 'output_model_std_1d.txt')
 model_std[~ind_active] = np.nan
 
-model_mean = np.mean(model, axis=-1)
+model_mean = np.loadtxt(path_o + 'output_model_mean_1d.txt')
 model_mean[~ind_active] = np.nan
 
 
@@ -4,28 +4,29 @@
 import sys
 sys.path.append('../../')
 import numpy as np
-from discretize import TensorMesh
 from shpmc.level_set_mc import StochasticLevelSet3D
+from shpmc.data_io import InputCache
 from shpmc.geo_stats import GaussianField
-import h5py
 
 path_i = './inputs/'
 path_o = './outputs/'
 
-mesh = TensorMesh._readUBC_3DMesh(path_i + 'mesh.txt')
+# Text inputs are parsed once and memory-mapped from a binary cache afterwards
+cache = InputCache()
+mesh = cache.mesh(path_i + 'mesh.txt')
 
-drillholes = mesh.read_model_UBC(path_i+'drillholes.txt')
-drillholes_3d = drillholes.reshape([mesh.shape_cells[0], mesh.shape_cells[1], mesh.shape_cells[2]], order='F')
+drillholes_3d = cache.model(mesh, path_i + 'drillholes.txt')
 
-outcrops = mesh.read_model_UBC(path_i+'outcrops.txt')
-outcrops_3d = outcrops.reshape([mesh.shape_cells[0], mesh.shape_cells[1], mesh.shape_cells[2]], order='F')
+outcrops_3d = cache.model(mesh, path_i + 'outcrops.txt')
 
 data_3d = [drillholes_3d, outcrops_3d]
 
+# Active cells below topography, UBC files are in Fortran order
+ind_active = np.array(cache.text(path_i + 'ind_active.txt', dtype=bool)).reshape(mesh.shape_cells, order='F')
+
 # Initial model
-initial = mesh.read_model_UBC(path_i + 'initial_model.txt')
-initial[np.isnan(initial)] = 0
-initial_3d = initial.reshape([mesh.shape_cells[0], mesh.shape_cells[1], mesh.shape_cells[2]], order='F')
+initial_3d = np.array(cache.model(mesh, path_i + 'initial_model.txt'))
+initial_3d[np.isnan(initial_3d)] = 0
 initial_3d = [initial_3d - 0.5]
 
 # Define params for 3d gaussian random fields
@@ -42,6 +43,7 @@ gf = GaussianField(
     z = mesh.cell_centers_z,
     random = True,
     output_params = True,
+    active = ind_active,
   )
 
 # McMC level set
@@ -50,16 +52,17 @@ L = StochasticLevelSet3D(
     initial_3d, 
     gaussian_field=gf, 
     max_step=1, 
+    active=ind_active,
     contribution=[1, 0.1]
     )
 
-loss_array, model_cache, acceptance_count = L.mcmc_sampling_single_chain(iter_num=1000, temperature=20)
-
-# Save data
+# Samples and posterior maps are streamed to the output file while sampling
 num_chain = 1
-hf = h5py.File(path_o + 'output_sampling_chain_{}.h5'.format(num_chain), 'w')
-hf.create_dataset('loss', data = loss_array)
-hf.create_dataset('acceptance', data = acceptance_count)
-hf.create_dataset('model_dist', data = model_cache)
-hf.close()
+loss_array, _, acceptance_count = L.mcmc_sampling_single_chain(
+    iter_num=1000, 
+    temperature=20, 
+    sink=path_o + 'output_sampling_chain_{}.h5'.format(num_chain),
+    burn_in=200,
+    thin=2,
+    )
 
@@ -58,14 +58,12 @@ outcrops_contact_coord = mesh.cell_centers[outcrops_contact_ind, :]
 # Drillholes locations on the surface for visualization
 drillholes_coord = np.loadtxt(path_i + "drillholes_coordinate.txt")
 
-# Compute mean and std models
+# Mean and std models
 # For visualization, please refer to examples/02-drillholes-outcrops-3d
-model = np.loadtxt(path_o + 'output_model_unique_1d.txt')
-
-model_std = np.std(model, axis=-1)
+model_std = np.loadtxt(path_o + 'output_model_std_1d.txt')
 model_std[~ind_active] = np.nan
 
-model_mean = np.mean(model, axis=-1)
+model_mean = np.loadtxt(path_o + 'output_model_mean_1d.txt')
 model_mean[~ind_active] = np.nan
 
 
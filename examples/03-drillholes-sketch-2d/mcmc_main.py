@@ -9,16 +9,10 @@ plt.rcParams['font.family'] = 'serif'
 plt.rcParams['font.serif'] = ['Times New Roman'] + plt.rcParams['font.serif']
 
 from discretize import TensorMesh
-import skfmm
-from tqdm import tqdm
 
-from shpmc.level_set_mc import level_set_perturbation
-from shpmc.geo_stats import GaussianField
-from shpmc.loss_functions import (
-    loss_function_binary, 
-    model_sign_dist_to_data, 
-    loss_ordinary_procrustes_analysis,
-    )
+from shpmc.level_set_mc import StochasticLevelSet2D
+from shpmc.geo_stats import GaussianField, PrefetchField
+from shpmc.constraints import SketchConstraint
 
 #%% Initialization
 path_i = './inputs/'
@@ -36,6 +30,9 @@ drillholes_2d = np.loadtxt(path_i + 'drillhole_vertical.txt')
 sketch_2d = np.loadtxt(path_i + 'sketch.txt')
 sketch_coord = cell_centers[np.where(sketch_2d.reshape(-1, order='F')==1)[0], :]
 
+# The model is compared with the sketch through the cell centers inside the target
+sketch = SketchConstraint(sketch_coord, coordinates=cell_centers)
+
 # Initial model
 initial_2d = np.loadtxt(path_i + 'initial_model.txt')
 initial_2d = initial_2d - 0.5
@@ -56,103 +53,39 @@ gf = GaussianField(
     output_params = True,
   )
 
-
 # Parameters of MCMC
 cd = 1 # Contribution of drillhole
 cs = 5 # Contribution of sketch
 temperature = 5
 max_step = 1
 iter_num = 5000
-sample_models = np.zeros((iter_num, *mesh.shape_cells)) # change for 2d
-loss_values = np.zeros((iter_num, 2))
-
-model_sign_dist_current = skfmm.distance(initial_2d)
 
-# Loss drillhole
-obs, obs_sign_dist, obs_sign_dist_contact = model_sign_dist_to_data(model_sign_dist_current, drillholes_2d)
-loss_drillhole = loss_function_binary(obs, obs_sign_dist, obs_sign_dist_contact, cd)
-
-# Loss sketch
-comparision_shape = np.zeros_like(sketch_2d)
-comparision_shape[model_sign_dist_current>0] = 1
-index = np.where(comparision_shape.reshape(-1, order='F')==1)[0]
-comparision_shape_coord = cell_centers[index, :]
-dist, Z, translation = loss_ordinary_procrustes_analysis(sketch_coord, comparision_shape_coord, cs)
+#%% Level set MCMC
+# Generate the fields in the background while the sampler runs the level set and loss
+with PrefetchField(gf, depth=4, dim=2) as prefetch:
 
-# Loss total
-loss_total_current = loss_drillhole + dist
+    L = StochasticLevelSet2D(
+        [drillholes_2d, sketch], 
+        [initial_2d], 
+        gaussian_field=prefetch, 
+        max_step=max_step, 
+        contribution=[cd, cs]
+        )
 
-# Storing initials
-loss_individual_current = [loss_drillhole, dist]
-loss_values[0, :] = loss_individual_current
-sample_models[0, :] = model_sign_dist_current
+    # Posterior maps of the last 2000 steps (every second step) are computed while sampling
+    num_chain = 2
+    loss_values, _, acceptance_count, summary = L.mcmc_sampling_single_chain(
+        iter_num=iter_num, 
+        temperature=temperature, 
+        sink=path_o + 'output_sampling_chain_{}.h5'.format(num_chain),
+        burn_in=iter_num-2000,
+        thin=2,
+        output_summary=True,
+        )
 
-acceptance_count = 1
+print('Waiting on velocity fields: {:.1f} s'.format(prefetch.wait_time))
 
-#%% Level set MCMC
-for ii in tqdm(np.arange(iter_num-1)):
-
-    # Create velocity fields
-    velocity_field, theta = gf.field_2d
-    
-    # Model perturbation
-    model_sign_dist_candidate = level_set_perturbation(model_sign_dist_current, velocity_field, max_step)
-    
-    # Loss drillhole
-    obs, obs_sign_dist, obs_sign_dist_contact = model_sign_dist_to_data(model_sign_dist_candidate, drillholes_2d)
-    loss_drillhole = loss_function_binary(obs, obs_sign_dist, obs_sign_dist_contact, cd)
-    
-    # Loss sketch
-    comparision_shape = np.zeros_like(sketch_2d)
-    comparision_shape[model_sign_dist_candidate>0] = 1
-    index = np.where(comparision_shape.reshape(-1, order='F')==1)[0]
-    comparision_shape_coord = cell_centers[index, :]
-    dist, Z, translation = loss_ordinary_procrustes_analysis(sketch_coord, comparision_shape_coord, cs)
-    
-    # Loss total
-    loss_individual_candidate = [loss_drillhole, dist]
-    loss_total_candidate = loss_drillhole + dist
-    
-    acceptance_ratio = (loss_total_current**2 - loss_total_candidate**2) / temperature
-    
-    # Accept
-    if np.log(np.random.uniform(0, 1)) <= acceptance_ratio:
-        loss_values[ii+1, :] = loss_individual_candidate
-        acceptance_count += 1
-        model_sign_dist_current = model_sign_dist_candidate
-        loss_total_current = loss_total_candidate
-    
-    # Reject
-    else:
-        loss_values[ii+1, :] = loss_values[ii, :]
-
-    sample_models[ii+1, :] = model_sign_dist_current
-    
-
-#%% Save data
-import h5py
-num_chain = 2
-hf = h5py.File(path_o + 'output_sampling_chain_{}.h5'.format(num_chain), 'w')
-hf.create_dataset('loss', data = loss_values)
-hf.create_dataset('acceptance', data = acceptance_count)
-hf.create_dataset('model_dist', data = sample_models)
-hf.close()
-
-
-#%% Processing
-cut_off = 2000
-independence = -1*np.arange(0, cut_off, 2)
-model_array_cut = sample_models[independence, :, :]
-
-n = model_array_cut.shape[0]
-model_1d = np.zeros([mesh.nC, n])
-model_dist_1d = np.zeros([mesh.nC, n])
-
-for i in np.arange(n):
-    m_dist_1d = np.reshape(model_array_cut[i, :, :], -1, order="F")
-    m = np.zeros(mesh.nC)
-    m[np.where(m_dist_1d >= 0)[0]] = 1
-    model_1d[:, i] = m
+posterior = summary['posterior']
 
 
 #%% Visualization
@@ -171,8 +104,7 @@ plt.savefig(path_o +'fig_loss.png', bbox_inches="tight", dpi=300)
 
 
 # Fig 2
-std = np.std(model_1d, 1)
-std_2d = std.reshape(mesh.shape_cells[0], mesh.shape_cells[1], order='F')
+std_2d = posterior.indicator_std
 fig = plt.figure()
 plt.imshow(std_2d.T, origin='lower')
 plt.imshow(drillholes_2d.T, origin='lower', cmap='binary')
@@ -181,8 +113,7 @@ plt.ylabel('Z')
 plt.savefig(path_o + 'fig_std.png')
 
 # Fig 3
-mean = np.mean(model_1d, 1)
-mean_2d = mean.reshape(mesh.shape_cells[0], mesh.shape_cells[1], order='F')
+mean_2d = posterior.probability
 fig = plt.figure()
 plt.imshow(mean_2d.T, origin='lower')
 plt.imshow(drillholes_2d.T, origin='lower', cmap='binary')
@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from . import adaptation
+from . import constraints
+from . import data_io
+from . import diagnostics
 from . import geo_stats
+from . import geophysics
 from . import level_set_mc
 from . import loss_functions
+from . import multiresolution
+from . import profiling
+from . import rescoring
+from . import statistics
+from . import storage
 from . import utils
 
 
-from .geo_stats import GaussianField
-from .level_set_mc import StochasticLevelSet3D, level_set_perturbation
+from .adaptation import StepSizeAdaptation
+from .constraints import BinaryConstraint, SketchConstraint, compile_constraints
+from .data_io import cell_index, point_constraint, drillhole_constraint, read_drillhole_intervals, read_outcrop_points, InputCache
+from .diagnostics import autocorrelation, split_rhat, effective_sample_size, geometric_summaries, ConvergenceMonitor
+from .geo_stats import GaussianField, SpectralGaussianField, PrefetchField
+from .geophysics import gravity_sensitivity, magnetic_sensitivity, load_sensitivity, GeophysicsConstraint
+from .level_set_mc import StochasticLevelSet, StochasticLevelSet2D, StochasticLevelSet3D, level_set_perturbation, signed_distance
 from .loss_functions import loss_function_binary, model_sign_dist_to_data, loss_ordinary_procrustes_analysis, find_sketch_cross_section
+from .multiresolution import coarsen_model, prolong_model, coarsen_active, coarsen_field, coarsen_mesh
+from .profiling import StageTimer
+from .rescoring import rescore_samples, importance_weights
+from .statistics import PosteriorStatistics
+from .storage import HDF5SampleWriter, write_datasets, read_indicators, read_models, read_multiplicity, indicator_statistics
 from .utils import transformation_matrix_2d, coord_transformation_2d
\ No newline at end of file
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+
+class StepSizeAdaptation(object):
+    """
+
+    Robbins-Monro adaptation of the maximum step of the level set perturbation.
+
+    After each proposal, log(max_step) moves by gain * (alpha - target), where
+    alpha = min(1, exp(acceptance ratio)) is the acceptance probability and the
+    gain decays as n**(-decay), so the step converges to the value that gives
+    the target acceptance rate. The adaptation only runs during burn-in; the
+    step is frozen afterwards to keep the sampling phase a valid Markov chain.
+
+    """
+
+
+    def __init__ (self, max_step, target_acceptance = 0.3, decay = 0.6, bounds = (1e-3, np.inf)):
+
+        """
+
+        Parameters
+        ----------
+        max_step : float
+            initial maximum step
+        target_acceptance : float, default: 0.3
+            target acceptance rate
+        decay : float, default: 0.6
+            decay exponent of the gain, in (0.5, 1]
+        bounds : tuple, default: (1e-3, np.inf)
+            lower and upper bounds of the maximum step
+
+        """
+
+        assert 0 < target_acceptance < 1, "The target acceptance rate must be in (0, 1)!"
+
+        self.target_acceptance = target_acceptance
+        self.decay = decay
+        self.bounds = bounds
+
+        self.n = 0
+        self.log_step = np.log(max_step)
+
+        # Adaptation trace
+        self.step_trace = []
+        self.acceptance_trace = []
+
+
+    @property
+    def max_step(self):
+
+        return np.exp(self.log_step)
+
+
+    def update(self, acceptance_ratio):
+        """
+
+        Update the maximum step after one proposal.
+
+        Parameters
+        ----------
+        acceptance_ratio : float
+            log acceptance ratio of the proposal
+
+        Returns
+        -------
+        float
+            maximum step of the next proposal
+
+        """
+
+        self.n += 1
+
+        alpha = np.exp(min(acceptance_ratio, 0)) if not np.isnan(acceptance_ratio) else 0.
+
+        self.log_step += (alpha - self.target_acceptance) / self.n**self.decay
+        self.log_step = np.clip(self.log_step, np.log(self.bounds[0]), np.log(self.bounds[1]))
+
+        self.step_trace.append(self.max_step)
+        self.acceptance_trace.append(alpha)
+
+        return self.max_step
+
+
+    def acceptance_rate(self, window = 100):
+        """
+
+        Mean acceptance probability of the last 'window' proposals
+
+        """
+
+        return np.mean(self.acceptance_trace[-window:]) if self.n > 0 else np.nan
+
+
+    def to_dict(self):
+        """
+
+        Adaptation trace as a dictionary, e.g., to be saved in HDF5
+
+        """
+
+        return {
+            'max_step': np.array(self.step_trace),
+            'acceptance': np.array(self.acceptance_trace),
+            'target_acceptance': self.target_acceptance,
+            }
+
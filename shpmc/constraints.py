@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import copy
+from shpmc.loss_functions import loss_function_binary
+from shpmc.multiresolution import block_mean, coarse_shape
+
+
+
+class BinaryConstraint(object):
+    """
+
+    Precompiled observation index of binary data, e.g., drillholes and outcrops.
+
+    The flat indices of the observed cells are computed once, so a loss
+    evaluation only gathers the signed distance at the observations instead
+    of scanning the full grid. Indices refer to the C-order flattened model,
+    which is the layout of the signed distance returned by skfmm.
+
+    """
+
+
+    def __init__ (self, shape, target_index, non_target_index, contact_index):
+
+        """
+
+        Parameters
+        ----------
+        shape : tuple
+            shape of the model grid
+        target_index : array
+            flat indices of the target cells (observations 1 and 0.5)
+        non_target_index : array
+            flat indices of the non-target cells (observations 0)
+        contact_index : array
+            flat indices of the contact cells (observations 0.5)
+
+        """
+
+        self.shape = tuple(shape)
+
+        self.target_index = np.asarray(target_index, dtype=np.intp)
+        self.non_target_index = np.asarray(non_target_index, dtype=np.intp)
+        self.contact_index = np.asarray(contact_index, dtype=np.intp)
+
+        # All observations sorted by cell, as in model_sign_dist_to_data
+        self.index = np.concatenate((self.target_index, self.non_target_index))
+        self.obs = np.concatenate((np.ones(len(self.target_index)), np.zeros(len(self.non_target_index))))
+
+        order = np.argsort(self.index, kind='stable')
+        self.index = self.index[order]
+        self.obs = self.obs[order]
+
+
+    @classmethod
+    def from_grid(cls, data):
+        """
+
+        Compile the observation index from a grid of observations.
+
+        Parameters
+        ----------
+        data : array
+            observations on the model grid, where 0, 1 and 0.5 indicate non-target,
+            target and contact points and NaN no observation
+
+        Returns
+        -------
+        BinaryConstraint
+
+        """
+
+        data_flat = np.ravel(data)
+
+        target_index = np.flatnonzero(data_flat > 0)
+        non_target_index = np.flatnonzero(data_flat == 0)
+        contact_index = np.flatnonzero(data_flat == 0.5)
+
+        return cls(np.shape(data), target_index, non_target_index, contact_index)
+
+
+    def restrict(self, active):
+        """
+
+        Observations in the active cells only.
+
+        The contact terms of the loss are means over the contact cells, so
+        the mask must keep at least one of them.
+
+        Parameters
+        ----------
+        active : array
+            boolean mask of the active cells on the model grid
+
+        Returns
+        -------
+        BinaryConstraint
+
+        """
+
+        active = np.ravel(active)
+
+        contact_index = self.contact_index[active[self.contact_index]]
+        if len(self.contact_index) > 0 and len(contact_index) == 0:
+            raise ValueError("All contact cells of the observations are inactive!")
+
+        return BinaryConstraint(
+            self.shape,
+            self.target_index[active[self.target_index]],
+            self.non_target_index[active[self.non_target_index]],
+            contact_index,
+            )
+
+
+    def coarsen(self, factor, shape = None):
+        """
+
+        Observations on a grid coarsened by 'factor' cells along every axis.
+
+        A coarse cell with a contact, or with both target and non-target
+        observations, is a contact cell, as in point_constraint.
+
+        Parameters
+        ----------
+        factor : int
+            coarsening factor
+        shape : tuple, default: None
+            shape of the fine model grid, the shape of the constraint if None
+
+        Returns
+        -------
+        BinaryConstraint
+
+        """
+
+        shape_coarse = coarse_shape(self.shape, factor)
+
+        def cells(index):
+            ijk = np.unravel_index(index, self.shape)
+            return np.unique(np.ravel_multi_index(tuple(ele // factor for ele in ijk), shape_coarse))
+
+        contact = cells(self.contact_index)
+        target = cells(self.target_index)
+        non_target = cells(self.non_target_index)
+
+        contact = np.union1d(contact, np.intersect1d(target, non_target))
+        target = np.union1d(target, contact)
+        non_target = np.setdiff1d(non_target, target)
+
+        return BinaryConstraint(shape_coarse, target, non_target, contact)
+
+
+    @property
+    def n_obs(self):
+
+        return len(self.index)
+
+
+    def to_grid(self):
+        """
+
+        Observations on the model grid, NaN where nothing is observed, e.g., for visualization
+
+        """
+
+        data = np.full(int(np.prod(self.shape)), np.nan)
+        data[self.non_target_index] = 0
+        data[self.target_index] = 1
+        data[self.contact_index] = 0.5
+
+        return data.reshape(self.shape)
+
+
+    def gather(self, model_sign_dist):
+        """
+
+        Signed distance at the observations.
+
+        Parameters
+        ----------
+        model_sign_dist : array
+            signed distance model
+
+        Returns
+        -------
+        obs : array
+            binary observations
+        obs_sign_dist : array
+            signed distance of the observations
+        obs_sign_dist_contact : array
+            signed distance of the observations at contact points only
+
+        """
+
+        # The loss is computed in double precision, also for float32 models
+        obs_sign_dist = np.take(model_sign_dist, self.index).astype(float, copy=False)
+        obs_sign_dist_contact = np.take(model_sign_dist, self.contact_index).astype(float, copy=False)
+
+        return self.obs, obs_sign_dist, obs_sign_dist_contact
+
+
+    def loss(self, model_sign_dist, contribution):
+        """
+
+        Loss function of the binary observations, see loss_function_binary.
+
+        """
+
+        obs, obs_sign_dist, obs_sign_dist_contact = self.gather(model_sign_dist)
+
+        return loss_function_binary(obs, obs_sign_dist, obs_sign_dist_contact, contribution)
+
+
+    def batch_loss(self, models, contribution):
+        """
+
+        Loss function of the binary observations for a stack of models.
+
+        Parameters
+        ----------
+        models : array
+            signed distance models, dim: n by model shape
+        contribution : int/float
+            hyperparameter controls the contribution of the loss function
+
+        Returns
+        -------
+        loss : array
+            loss values of each model
+
+        """
+
+        models = np.reshape(models, (len(models), -1))
+
+        obs_sign_dist = models[:, self.index].astype(float, copy=False)
+        obs_sign_dist_contact = models[:, self.contact_index].astype(float, copy=False)
+
+        # Logistic loss function, see loss_function_binary
+        O_0k = (np.log(1+np.exp(obs_sign_dist[:, self.obs==0]))/np.log2(2)).sum(1)
+        O_1k = (np.log(1+np.exp(-obs_sign_dist[:, self.obs==1]))/np.log2(2)).sum(1)
+
+        O_ik = O_0k+O_1k
+        O_ik[np.isnan(O_ik)] = 1e5
+
+        O_bias = np.square(np.mean(obs_sign_dist_contact, 1))
+        O_var = np.mean(np.square(obs_sign_dist_contact), 1)
+
+        return contribution * (O_ik + O_bias + O_var)
+
+
+
+class SketchConstraint(object):
+    """
+
+    Precompiled geological sketch compared with model cross-sections by Procrustes analysis.
+
+    The reference shape is centred and normalised once. The inside-cell
+    coordinates of all the selected cross-sections are gathered into a
+    preallocated buffer and their Procrustes distances are computed with one
+    batched SVD; the loss is the mean distance over the cross-sections.
+
+    """
+
+
+    def __init__ (self, shape_reference, ind_ = None, direction = None, coordinates = None, subset = None):
+
+        """
+
+        Parameters
+        ----------
+        shape_reference : array, dim: N by 2
+            coordinates of the geological sketch
+        ind_ : int or list, default: None
+            index, or first and last index, of the cross-sections in a 3D model.
+            None for a 2D model, which is compared as a whole.
+        direction : str, default: None
+            cross-section direction ("x", "y", "z") in a 3D model
+        coordinates : array, dim: P by 2, default: None
+            coordinates of the cross-section cells, first index varying fastest
+            (e.g., mesh.cell_centers in 2D). Cell indices are used if None.
+        subset : int or list, default: None
+            cross-sections used in the loss: all in the range if None, a number of evenly
+            spaced cross-sections if int, or a list of indices
+
+        """
+
+        self.shape_reference = np.asarray(shape_reference, dtype=float)
+        self.ind_ = ind_
+        self.direction = direction
+        self.coordinates = coordinates
+
+        # Reference shape
+        self.mu_ref = self.shape_reference.mean(0)
+        shape_reference_centered = self.shape_reference - self.mu_ref
+        self.F_norm_ref = np.sqrt((shape_reference_centered**2.).sum())
+        self.shape_reference_centered = shape_reference_centered / self.F_norm_ref
+
+        # Cross-sections
+        if ind_ is None:
+            self.axis = None
+            self.slices = np.array([0])
+
+        else:
+            self.axis = {'x': 0, 'y': 1, 'z': 2}[direction]
+
+            if isinstance(ind_, list):
+                slices = np.arange(ind_[0], ind_[-1]+1)
+            else:
+                slices = np.array([ind_])
+
+            if subset is None:
+                self.slices = slices
+            elif np.ndim(subset) == 0:
+                self.slices = np.unique(slices[np.linspace(0, len(slices)-1, subset).round().astype(int)])
+            else:
+                self.slices = np.asarray(subset)
+
+        # Padded buffer of the comparison shapes, allocated on first use
+        self._buffer = None
+
+
+    def coarsen(self, factor, shape):
+        """
+
+        Sketch constraint on a grid coarsened by 'factor' cells along every axis.
+
+        The Procrustes distance does not depend on the scale, so the reference
+        shape is kept; the cross-sections and the cell coordinates are coarsened.
+
+        Parameters
+        ----------
+        factor : int
+            coarsening factor
+        shape : tuple
+            shape of the fine model grid
+
+        Returns
+        -------
+        SketchConstraint
+
+        """
+
+        coarse = copy.copy(self)
+        coarse._buffer = None
+
+        if self.axis is not None:
+            coarse.slices = np.unique(self.slices // factor)
+
+        if self.coordinates is not None:
+            shape = tuple(shape) if self.axis is None else tuple(np.delete(shape, self.axis))
+            coords = np.reshape(self.coordinates, (*shape, 2), order='F')
+            coords = [block_mean(coords[..., k], factor) for k in range(2)]
+            coarse.coordinates = np.stack([ele.ravel(order='F') for ele in coords], 1)
+
+        return coarse
+
+
+    def sections(self, model_sign_dist):
+        """
+
+        Cross-sections of the model, each one flattened with the first index varying fastest
+
+        """
+
+        return self._sections(model_sign_dist[None])[0]
+
+
+    def _sections(self, models):
+        """
+
+        Cross-sections of a stack of models, dim: n by cross-sections by cells
+
+        """
+
+        if self.axis is None:
+            sections = models[:, None]
+        else:
+            sections = np.moveaxis(np.take(models, self.slices, axis=self.axis+1), self.axis+1, 1)
+
+        return np.swapaxes(sections, -1, -2).reshape(*sections.shape[:2], -1)
+
+
+    def distance(self, model_sign_dist):
+        """
+
+        Procrustes distance of every selected cross-section to the reference shape.
+
+        Parameters
+        ----------
+        model_sign_dist : array
+            signed distance model
+
+        Returns
+        -------
+        dist : array
+            distance of each cross-section, 1 (no similarity) for an empty cross-section
+
+        """
+
+        masks = self.sections(model_sign_dist) > 0
+
+        if self._buffer is None or self._buffer.shape[0] != len(masks):
+            self._buffer = np.zeros((len(masks), len(self.shape_reference), 2))
+
+        return self._distance(masks, model_sign_dist.shape, self._buffer)
+
+
+    def _distance(self, masks, shape, buffer):
+        """
+
+        Procrustes distance of the inside cells 'masks' (dim: cross-sections by cells) of
+        models of 'shape', with 'buffer' the padded comparison shapes (dim: cross-sections
+        by reference points by 2)
+
+        """
+
+        if self.coordinates is None:
+            if self.axis is not None:
+                shape = np.delete(shape, self.axis)
+            i, j = np.unravel_index(np.arange(masks.shape[1]), shape, order='F')
+            self.coordinates = np.stack((i, j), 1).astype(float)
+
+        coords = self.coordinates
+        n_ref = len(self.shape_reference)
+
+        buffer.fill(0)
+
+        # Centroid and Frobenius norm of the comparison shapes
+        counts = masks.sum(1)
+        valid = counts > 0
+        mu_comp = (masks @ coords) / np.maximum(counts, 1)[:, None]
+        F_norm_comp = np.sqrt(np.maximum(masks @ (coords**2).sum(1) - counts * (mu_comp**2).sum(1), 0))
+
+        # Only the first n_ref points pair with the reference, the rest pair with its zero padding
+        ranks = np.cumsum(masks, 1) - 1
+        s_idx, p_idx = np.nonzero(masks & (ranks < n_ref))
+        buffer[s_idx, ranks[s_idx, p_idx]] = coords[p_idx] - mu_comp[s_idx]
+
+        # Optimal rotation for all cross-sections in one SVD
+        A = np.einsum('kd,skc->sdc', self.shape_reference_centered, buffer)
+        A /= np.where(F_norm_comp > 0, F_norm_comp, 1)[:, None, None]
+        s = np.linalg.svd(A, compute_uv=False)
+
+        dist = 1 - s.sum(1)**2
+        dist[~valid] = 1
+
+        return dist
+
+
+    def loss(self, model_sign_dist, contribution):
+        """
+
+        Procrustes loss, i.e., the mean distance over the selected cross-sections
+
+        """
+
+        return contribution * self.distance(model_sign_dist).mean()
+
+
+    def batch_loss(self, models, contribution):
+        """
+
+        Procrustes loss for a stack of models.
+
+        The cross-sections of all models are compared with the reference in
+        one batched SVD.
+
+        Parameters
+        ----------
+        models : array
+            signed distance models, dim: n by model shape
+        contribution : int/float
+            hyperparameter controls the contribution of the loss function
+
+        Returns
+        -------
+        loss : array
+            loss values of each model
+
+        """
+
+        models = np.asarray(models)
+        masks = self._sections(models) > 0
+        n_model, n_section, n_cell = masks.shape
+
+        buffer = np.zeros((n_model * n_section, len(self.shape_reference), 2))
+        dist = self._distance(masks.reshape(-1, n_cell), models.shape[1:], buffer)
+
+        return contribution * dist.reshape(n_model, n_section).mean(1)
+
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+
+        return state
+
+
+
+def compile_constraints(data):
+    """
+
+    Compile the data sets used in the loss computation.
+
+    Parameters
+    ----------
+    data : list
+        data sets, arrays of binary observations are compiled into BinaryConstraint,
+        geological sketches [shape_reference, ind_, direction] into SketchConstraint,
+        and constraint objects are kept as they are
+
+    Returns
+    -------
+    list
+        compiled data sets
+
+    """
+
+    constraints = []
+
+    for ele in data:
+
+        if isinstance(ele, np.ndarray):
+            constraints.append(BinaryConstraint.from_grid(ele))
+
+        elif isinstance(ele, list):
+            constraints.append(SketchConstraint(*ele))
+
+        else:
+            constraints.append(ele)
+
+    return constraints
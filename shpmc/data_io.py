@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import hashlib
+import os
+from shpmc.constraints import BinaryConstraint
+
+
+
+def cell_index(mesh, points):
+
+    """
+
+    Cells of a TensorMesh containing the points.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model
+    points : array, dim: N by 3
+        point coordinates (x, y, z)
+
+    Returns
+    -------
+    index : array
+        flat C-order indices on the model grid (mesh.shape_cells), -1 for points outside the mesh
+
+    """
+
+    points = np.atleast_2d(points)
+    nodes = [mesh.nodes_x, mesh.nodes_y, mesh.nodes_z]
+
+    ijk = []
+    inside = np.ones(len(points), dtype=bool)
+
+    for count, ele in enumerate(nodes):
+
+        i = np.searchsorted(ele, points[:, count], side='right') - 1
+
+        # Points on the last node, e.g., outcrops on the top face
+        i[points[:, count] == ele[-1]] = len(ele) - 2
+
+        inside &= (i >= 0) & (i < len(ele) - 1)
+        ijk.append(np.clip(i, 0, len(ele) - 2))
+
+    index = np.ravel_multi_index(ijk, mesh.shape_cells)
+    index[~inside] = -1
+
+    return index
+
+
+
+def point_constraint(mesh, points, values):
+
+    """
+
+    Binary constraint from point observations, e.g., outcrop contacts.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model
+    points : array, dim: N by 3
+        point coordinates (x, y, z)
+    values : array
+        observations, where 0, 1 and 0.5 indicate non-target, target and contact points
+
+    Returns
+    -------
+    BinaryConstraint
+        the observations mapped to cells, points outside the mesh are discarded.
+        A cell with a contact, or with both target and non-target points, is a contact cell.
+
+    """
+
+    values = np.asarray(values, dtype=float)
+    index = cell_index(mesh, points)
+
+    inside = index >= 0
+    index, values = index[inside], values[inside]
+
+    cells, inverse = np.unique(index, return_inverse=True)
+
+    n_target = np.bincount(inverse, weights=(values == 1), minlength=len(cells))
+    n_non_target = np.bincount(inverse, weights=(values == 0), minlength=len(cells))
+    n_contact = np.bincount(inverse, weights=(values == 0.5), minlength=len(cells))
+
+    contact = (n_contact > 0) | ((n_target > 0) & (n_non_target > 0))
+    target = contact | (n_target > 0)
+    non_target = ~target & (n_non_target > 0)
+
+    return BinaryConstraint(mesh.shape_cells, cells[target], cells[non_target], cells[contact])
+
+
+
+def drillhole_constraint(mesh, collars, intervals, target, step = None):
+
+    """
+
+    Binary constraint from drillhole interval tables.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model
+    collars : dict
+        hole id -> (x, y, z) or (x, y, z, azimuth, dip) of the collar. Azimuth is clockwise
+        from north and dip is positive downward in degrees; holes are vertical by default.
+    intervals : list
+        (hole id, from depth, to depth, lithology) of each interval
+    target : int/float or list
+        lithology codes of the target
+    step : float, default: None
+        sampling step along the holes, half of the smallest cell size if None
+
+    Returns
+    -------
+    BinaryConstraint
+        the observations mapped to cells. Cells where the lithology changes between
+        consecutive intervals of a hole are contact cells.
+
+    """
+
+    if step is None:
+        step = 0.5 * min(np.min(mesh.h[0]), np.min(mesh.h[1]), np.min(mesh.h[2]))
+
+    target = np.atleast_1d(target)
+
+    points, values = [], []
+    previous = {}
+
+    for hole, depth_from, depth_to, lithology in sorted(intervals, key=lambda ele: (str(ele[0]), ele[1])):
+
+        collar = np.asarray(collars[hole], dtype=float)
+        azimuth, dip = (collar[3], collar[4]) if len(collar) > 3 else (0., 90.)
+
+        azimuth, dip = azimuth * np.pi/180, dip * np.pi/180
+        direction = np.array([np.cos(dip) * np.sin(azimuth), np.cos(dip) * np.cos(azimuth), -np.sin(dip)])
+
+        value = float(np.isin(lithology, target))
+
+        # Samples along the interval
+        n = max(int(np.ceil((depth_to - depth_from) / step)), 1)
+        depth = depth_from + (np.arange(n) + 0.5) * (depth_to - depth_from) / n
+
+        points.append(collar[:3] + depth[:, None] * direction)
+        values.append(np.full(n, value))
+
+        # Contact with the previous interval of the hole
+        if hole in previous and previous[hole] != value:
+            points.append(collar[None, :3] + depth_from * direction)
+            values.append(np.array([0.5]))
+
+        previous[hole] = value
+
+    return point_constraint(mesh, np.concatenate(points), np.concatenate(values))
+
+
+
+def read_drillhole_intervals(mesh, collar_file, interval_file, target, step = None, delimiter = None):
+
+    """
+
+    Read drillhole collar and interval tables into a binary constraint.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model
+    collar_file : str
+        text table with columns: hole id, x, y, z and optionally azimuth, dip (for all rows)
+    interval_file : str
+        text table with columns: hole id, from depth, to depth, lithology
+    target : int/float or list
+        lithology codes of the target
+    step : float, default: None
+        sampling step along the holes, see drillhole_constraint
+    delimiter : str, default: None
+        column delimiter, whitespace if None. Lines starting with '#' are ignored.
+
+    Returns
+    -------
+    BinaryConstraint
+
+    """
+
+    table = np.atleast_2d(np.genfromtxt(collar_file, dtype=str, comments='#', delimiter=delimiter))
+    collars = {ele[0]: ele[1:].astype(float) for ele in table}
+
+    table = np.atleast_2d(np.genfromtxt(interval_file, dtype=str, comments='#', delimiter=delimiter))
+    intervals = [(ele[0], float(ele[1]), float(ele[2]), float(ele[3])) for ele in table]
+
+    return drillhole_constraint(mesh, collars, intervals, target, step)
+
+
+
+def read_outcrop_points(mesh, filename, delimiter = None):
+
+    """
+
+    Read outcrop observations into a binary constraint.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model
+    filename : str
+        text table with columns: x, y, z, observation (0, 1 or 0.5 for contacts)
+    delimiter : str, default: None
+        column delimiter, whitespace if None. Lines starting with '#' are ignored.
+
+    Returns
+    -------
+    BinaryConstraint
+
+    """
+
+    table = np.atleast_2d(np.loadtxt(filename, comments='#', delimiter=delimiter))
+
+    return point_constraint(mesh, table[:, :3], table[:, 3])
+
+
+
+class InputCache(object):
+    """
+
+    Binary cache of the text inputs, i.e., UBC mesh and model files and text arrays.
+
+    Each input is parsed once and saved as .npy (.npz for meshes) next to it,
+    keyed by the path, size and modification time of the source file and, for
+    models, the mesh. A cache hit only stats the source file, so later runs
+    and worker processes memory-map the cached arrays without reading the
+    text. Models are cached on the model grid (mesh.shape_cells) used by the
+    sampler.
+
+    """
+
+
+    def __init__ (self, cache_dir = None):
+
+        """
+
+        Parameters
+        ----------
+        cache_dir : str, default: None
+            directory of the cached files, '.shpmc_cache' next to each source file if None
+
+        """
+
+        self.cache_dir = cache_dir
+
+
+    def mesh(self, filename):
+        """
+
+        Read a UBC 3D mesh file.
+
+        Returns
+        -------
+        discretize.TensorMesh
+
+        """
+
+        from discretize import TensorMesh
+
+        path = self._path(filename, 'mesh', '.npz')
+
+        if not os.path.exists(path):
+
+            mesh = TensorMesh._readUBC_3DMesh(filename)
+            self._save(path, np.savez, hx=mesh.h[0], hy=mesh.h[1], hz=mesh.h[2], origin=mesh.origin)
+
+        with np.load(path) as cache:
+            return TensorMesh([cache['hx'], cache['hy'], cache['hz']], origin=cache['origin'])
+
+
+    def model(self, mesh, filename):
+        """
+
+        Read a UBC model file on the model grid.
+
+        Returns
+        -------
+        array
+            read-only memory-mapped model of shape mesh.shape_cells, copy it to modify
+
+        """
+
+        path = self._path(filename, 'model', '.npy', mesh)
+
+        if not os.path.exists(path):
+
+            model = mesh.read_model_UBC(filename)
+            model = model.reshape(mesh.shape_cells, order='F')
+            self._save(path, np.save, model)
+
+        return np.load(path, mmap_mode='r')
+
+
+    def text(self, filename, **kwargs):
+        """
+
+        Read a text array with np.loadtxt, e.g., ind_active.txt or the 2D inputs.
+
+        Parameters
+        ----------
+        **kwargs :
+            arguments of np.loadtxt, they are part of the cache key
+
+        Returns
+        -------
+        array
+            read-only memory-mapped array, copy it to modify
+
+        """
+
+        path = self._path(filename, 'text' + repr(sorted(kwargs.items())), '.npy')
+
+        if not os.path.exists(path):
+            self._save(path, np.save, np.loadtxt(filename, **kwargs))
+
+        return np.load(path, mmap_mode='r')
+
+
+    def _path(self, filename, kind, ext, mesh = None):
+        """
+
+        Cache file of a source file read as 'kind' (on 'mesh'), the stale entries of
+        the same source, kind and mesh are removed.
+
+        """
+
+        # Entry of the source path, kind and mesh signature
+        source = hashlib.sha1()
+        source.update(os.path.abspath(filename).encode())
+        source.update(kind.encode())
+
+        if mesh is not None:
+            source.update(repr(tuple(mesh.shape_cells)).encode())
+            for ele in (*mesh.h, mesh.origin):
+                source.update(np.ascontiguousarray(ele, dtype=float).tobytes())
+
+        # Version of the source file, without reading it
+        stat = os.stat(filename)
+
+        digest = hashlib.sha1()
+        digest.update('{}.{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), '.shpmc_cache')
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        prefix = '{}.{}.'.format(os.path.basename(filename), source.hexdigest()[:16])
+        name = prefix + digest.hexdigest()[:16] + ext
+        path = os.path.join(cache_dir, name)
+
+        if not os.path.exists(path):
+            for ele in os.listdir(cache_dir):
+                if ele.startswith(prefix) and ele.endswith(ext) and ele != name:
+                    os.remove(os.path.join(cache_dir, ele))
+
+        return path
+
+
+    def _save(self, path, save, *args, **kwargs):
+        """
+
+        Write to a temporary file first, so concurrent workers never read a partial file.
+
+        """
+
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp, 'wb') as f:
+            save(f, *args, **kwargs)
+
+        os.replace(tmp, path)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import time
+from scipy import fft
+
+
+
+def autocorrelation(x, max_lag = None):
+    """
+
+    Autocorrelation of a trace computed by FFT.
+
+    Parameters
+    ----------
+    x : array
+        trace of one chain
+    max_lag : int, default: None
+        largest lag returned, all lags if None
+
+    Returns
+    -------
+    array
+        autocorrelation at lags 0 to max_lag
+
+    """
+
+    acov = _autocovariance(x, max_lag)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return acov / acov[0]
+
+
+
+def _autocovariance(x, max_lag = None):
+    """
+
+    Biased autocovariance of a trace computed by FFT
+
+    """
+
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+
+    if max_lag is None:
+        max_lag = n - 1
+
+    x = x - x.mean()
+    f = fft.rfft(x, n=fft.next_fast_len(2*n))
+
+    return fft.irfft(f * np.conjugate(f), n=fft.next_fast_len(2*n))[:max_lag+1] / n
+
+
+
+def _split_chains(chains):
+    """
+
+    Split each chain in two halves, dropping the middle iteration of odd chains
+
+    """
+
+    chains = np.atleast_2d(chains)
+    half = chains.shape[1] // 2
+
+    return np.concatenate((chains[:, :half], chains[:, -half:]))
+
+
+
+def split_rhat(chains):
+    """
+
+    Split potential scale reduction factor (Gelman et al., 2013).
+
+    Parameters
+    ----------
+    chains : array, dim: m by n
+        traces of m chains, a single chain is compared between its two halves
+
+    Returns
+    -------
+    float
+        split-Rhat, close to 1 for converged chains and NaN for constant traces
+
+    """
+
+    chains = _split_chains(chains)
+    m, n = chains.shape
+
+    W = chains.var(1, ddof=1).mean()
+    B = n * chains.mean(1).var(ddof=1)
+
+    var_plus = (n-1)/n * W + B/n
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(var_plus / W)
+
+
+
+def effective_sample_size(chains):
+    """
+
+    Effective sample size of split chains with Geyer's initial monotone sequence.
+
+    Parameters
+    ----------
+    chains : array, dim: m by n
+        traces of m chains
+
+    Returns
+    -------
+    float
+        effective sample size, 0 for constant traces
+
+    """
+
+    chains = _split_chains(chains)
+    m, n = chains.shape
+
+    if n < 2:
+        return 0.
+
+    acov = np.array([_autocovariance(ele) for ele in chains])
+
+    W = chains.var(1, ddof=1).mean()
+    B = n * chains.mean(1).var(ddof=1)
+    var_plus = (n-1)/n * W + B/n
+
+    if not var_plus > 0:
+        return 0.
+
+    rho = 1 - (W - acov.mean(0)) / var_plus
+    rho[0] = 1
+
+    # Sums of pairs of autocorrelations, positive and monotone
+    n_pair = len(rho) // 2
+    pairs = rho[:2*n_pair].reshape(n_pair, 2).sum(1)
+
+    negative = np.flatnonzero(pairs <= 0)
+    pairs = pairs[:negative[0] if len(negative) > 0 else n_pair]
+    pairs = np.minimum.accumulate(pairs)
+
+    tau = max(-1 + 2 * pairs.sum(), 1/np.log10(m*n))
+
+    return m * n / tau
+
+
+
+def geometric_summaries(model_sign_dist, active = None):
+    """
+
+    Summaries of the target geometry traced for the convergence diagnostics.
+
+    Parameters
+    ----------
+    model_sign_dist : array
+        signed distance model
+    active : array, default: None
+        boolean mask of the active cells, the volume fraction is relative to them
+
+    Returns
+    -------
+    array
+        volume fraction of the target and its centroid in cell indices (one value per axis)
+
+    """
+
+    indicator = model_sign_dist >= 0
+    count = indicator.sum()
+
+    size = indicator.size if active is None else np.count_nonzero(active)
+    summaries = [count / size]
+
+    for axis in range(indicator.ndim):
+        profile = indicator.sum(tuple(ele for ele in range(indicator.ndim) if ele != axis))
+        summaries.append(np.arange(len(profile)) @ profile / max(count, 1))
+
+    return np.array(summaries)
+
+
+
+class ConvergenceMonitor(object):
+    """
+
+    Online convergence diagnostics and stopping rule of the samplers.
+
+    The total loss and the geometric summaries (volume fraction and centroid
+    of the target) are traced at every iteration. Every 'check_interval'
+    iterations after burn-in, the split-Rhat and the effective sample size
+    of each traced quantity are computed from the iterations after burn-in
+    of all chains. Sampling stops when every ESS reaches 'min_ess' and every
+    split-Rhat is below 'max_rhat', or when the wall-clock budget is used up.
+
+    """
+
+
+    def __init__ (self, min_ess = None, max_rhat = 1.01, time_budget = None, check_interval = 100, max_lag = 100):
+
+        """
+
+        Parameters
+        ----------
+        min_ess : float, default: None
+            effective sample size (in iterations, summed over the chains) required to stop, 
+            None to stop on the time budget only
+        max_rhat : float, default: 1.01
+            split-Rhat required to stop
+        time_budget : float, default: None
+            wall-clock budget in seconds, no budget if None
+        check_interval : int, default: 100
+            number of iterations between diagnostics
+        max_lag : int, default: 100
+            largest lag of the reported autocorrelation of the total loss
+
+        """
+
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.time_budget = time_budget
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+
+        self.start()
+
+
+    def start(self, burn_in = 0):
+        """
+
+        Reset the diagnostics and the clock at the start of sampling.
+
+        """
+
+        self.burn_in = burn_in
+        self.stopped = None
+
+        self.iteration = []
+        self.ess = []
+        self.rhat = []
+        self.elapsed = []
+        self.loss_autocorrelation = np.array([])
+
+        self._start = time.perf_counter()
+        self._next_check = self.check_interval
+
+
+    def allocate(self, iter_num, n_summary, burn_in = 0):
+        """
+
+        Start the diagnostics of a single chain.
+
+        Returns
+        -------
+        array
+            trace buffer, dim: iter_num by n_summary
+
+        """
+
+        self.start(burn_in)
+
+        return np.zeros((iter_num, n_summary))
+
+
+    def diagnose(self, traces):
+        """
+
+        Diagnostics of the traces after burn-in.
+
+        Parameters
+        ----------
+        traces : array, dim: m chains by n iterations by k quantities
+            traces after burn-in
+
+        Returns
+        -------
+        ess : array
+            effective sample size of each quantity
+        rhat : array
+            split-Rhat of each quantity
+
+        """
+
+        ess = np.array([effective_sample_size(traces[:, :, k]) for k in range(traces.shape[2])])
+        rhat = np.array([split_rhat(traces[:, :, k]) for k in range(traces.shape[2])])
+
+        return ess, rhat
+
+
+    def update(self, traces, n):
+        """
+
+        Check the stopping rule.
+
+        Parameters
+        ----------
+        traces : array, dim: m chains by iterations by k quantities
+            traces of the chains, filled up to iteration n
+        n : int
+            number of iterations done by every chain
+
+        Returns
+        -------
+        bool
+            True to stop sampling
+
+        """
+
+        if self.time_budget is not None and time.perf_counter() - self._start >= self.time_budget:
+            self.stopped = 'time_budget'
+            return True
+
+        if n - self.burn_in < self._next_check:
+            return False
+
+        self._next_check = n - self.burn_in + self.check_interval
+
+        traces = traces[:, self.burn_in:n]
+        ess, rhat = self.diagnose(traces)
+
+        self.iteration.append(n)
+        self.ess.append(ess)
+        self.rhat.append(rhat)
+        self.elapsed.append(time.perf_counter() - self._start)
+        self.loss_autocorrelation = autocorrelation(traces[0, :, 0], min(self.max_lag, traces.shape[1]-1))
+
+        if self.min_ess is not None and np.all(ess >= self.min_ess) and np.all(rhat < self.max_rhat):
+            self.stopped = 'converged'
+            return True
+
+        return False
+
+
+    def __getstate__(self):
+
+        # The clock is saved as the elapsed time, e.g., in a checkpoint
+        state = self.__dict__.copy()
+        state['_start'] = time.perf_counter() - self._start
+
+        return state
+
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._start = time.perf_counter() - state['_start']
+
+
+    def to_dict(self):
+        """
+
+        Diagnostics history as a dictionary, e.g., to be saved in HDF5
+
+        """
+
+        return {
+            'iteration': np.array(self.iteration, dtype=int),
+            'ess': np.array(self.ess),
+            'rhat': np.array(self.rhat),
+            'elapsed': np.array(self.elapsed),
+            'loss_autocorrelation': self.loss_autocorrelation,
+            'stopped': str(self.stopped),
+            }
+
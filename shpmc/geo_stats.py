@@ -3,6 +3,11 @@
 
 import gstools as gs
 import numpy as np
+from scipy import fft
+import os
+import queue
+import threading
+import time
 
 
 
@@ -29,6 +34,8 @@ class GaussianField(object):
             z,
             random = False,
             output_params = False,
+            dtype = np.float64,
+            active = None,
             ):
         
         """
@@ -55,6 +62,11 @@ class GaussianField(object):
             generate random gaussian field
         output_params: bool, default: False
             output the parameters for random gaussian field
+        dtype: data-type, default: np.float64
+            data type of the fields, e.g., np.float32 to halve their memory
+        active: array, default: None
+            boolean mask of the active cells (e.g., below topography), the field is only 
+            generated at their centres and is zero in the inactive cells
 
         """
         
@@ -65,6 +77,10 @@ class GaussianField(object):
         
         self.random = random
         self.output = output_params
+        self.dtype = np.dtype(dtype)
+        self.active = None if active is None else np.asarray(active, dtype=bool)
+        
+        self._positions = None
         
     
     def field_function_3d(self, theta, x, y, z):
@@ -97,7 +113,11 @@ class GaussianField(object):
             angles = [theta[5] * np.pi/180, theta[6] * np.pi/180],
             )
 
-        srf = gs.SRF(model)
+        # Seed from NumPy so the field follows the random stream of the chain
+        srf = gs.SRF(model, seed = np.random.randint(2**31))
+        
+        if self.active is not None:
+            return self._active_field(srf, [x, y, z], theta[0])
         
         return srf.structured([x, y, z]) + theta[0]
     
@@ -117,11 +137,31 @@ class GaussianField(object):
             angles = [theta[4] * np.pi/180],
             )
 
-        srf = gs.SRF(model)
+        # Seed from NumPy so the field follows the random stream of the chain
+        srf = gs.SRF(model, seed = np.random.randint(2**31))
+        
+        if self.active is not None:
+            return self._active_field(srf, [x, y], theta[0])
         
         return srf.structured([x, y]) + theta[0]
     
     
+    def _active_field(self, srf, coords, mean):
+        """
+        
+        Field generated at the centres of the active cells only, zero in the inactive cells
+        
+        """
+        
+        if self._positions is None:
+            self._positions = [ele[self.active] for ele in np.meshgrid(*coords, indexing='ij')]
+        
+        field = np.zeros(self.active.shape)
+        field[self.active] = srf(self._positions) + mean
+        
+        return field
+    
+    
     @property    
     def field_3d(self):
         """
@@ -161,6 +201,8 @@ class GaussianField(object):
             
             field =  self.field_function_3d(theta, self.x, self.y, self.z)
         
+        field = field.astype(self.dtype, copy=False)
+        
         if self.output:
             
             return field, theta
@@ -207,10 +249,412 @@ class GaussianField(object):
             
             field =  self.field_function_2d(theta, self.x, self.y)
         
+        field = field.astype(self.dtype, copy=False)
+        
         if self.output:
             
             return field, theta
         else:
             
             return field
-        
\ No newline at end of file
+        
+
+
+class SpectralGaussianField(GaussianField):
+    """
+    
+    Generate gaussian fields on regular grids by FFT circulant embedding.
+    
+    The Gaussian covariance of the gstools model is periodized on a padded 
+    grid. Its spectrum is the analytic spectral density of the model at the 
+    FFT wavenumbers, so a new field costs the evaluation of one Gaussian in 
+    the wavenumber domain and one FFT of random complex noise. The range and 
+    anisotropy parameters are drawn as in GaussianField, without binning.
+    
+    The periodization and the aliasing beyond the Nyquist wavenumber are the 
+    approximations of the embedding; both vanish for a padding of a few 
+    ranges and ranges of a few cells.
+    
+    """
+    
+    
+    def __init__ (
+            self, 
+            *args,
+            padding = 3,
+            workers = None,
+            **kwargs
+            ):
+        
+        """
+    
+        Parameters
+        ----------
+        *args, **kwargs : 
+            parameters of GaussianField
+        padding : float, default: 3
+            padding of the periodic grid in units of the largest range
+        workers : int, default: None
+            number of threads used by scipy.fft
+
+        """
+        
+        super().__init__(*args, **kwargs)
+        
+        self.padding = padding
+        self.workers = workers
+        
+        self._grids = {}
+        self._buffers = {}
+    
+    
+    def field_function_3d(self, theta, x, y, z):
+        """
+        
+        Gaussian field in 3D
+
+        """
+        
+        ranges = [self.range_x, self.range_y, self.range_z]
+        
+        return self._field_function(theta, ranges, [x, y, z])
+    
+    
+    def field_function_2d(self, theta, x, y):
+        """
+        
+        Gaussian field in 2D
+
+        """
+        
+        ranges = [self.range_x, self.range_y]
+        
+        return self._field_function(theta, ranges, [x, y])
+    
+    
+    def _field_function(self, theta, ranges, coords):
+        
+        dim = len(coords)
+        
+        sqrt_lambda = self._spectrum(theta, ranges, coords)
+        
+        # Complex white noise times the square root of the spectrum, in single precision for float32 fields
+        buffer = self._buffers.get(dim)
+        if buffer is None:
+            buffer = self._buffers[dim] = np.zeros(sqrt_lambda.shape, dtype=np.result_type(self.dtype, np.complex64))
+        
+        buffer.real = np.random.standard_normal(buffer.shape)
+        buffer.imag = np.random.standard_normal(buffer.shape)
+        buffer *= sqrt_lambda
+        
+        field = fft.fftn(buffer, overwrite_x=True, workers=self.workers)
+        field = field.real[tuple(slice(0, len(ele)) for ele in coords)]
+        
+        # Scale into a new array, the FFT output may share the reused buffer
+        output = np.empty(field.shape, dtype=self.dtype)
+        np.multiply(field, np.sqrt(theta[1]), out=output)
+        output += theta[0]
+        
+        # The FFT covers the whole grid, the inactive cells are only cleared
+        if self.active is not None:
+            output[~self.active] = 0
+        
+        return output
+    
+    
+    def _grid(self, ranges, coords):
+        """
+        
+        Wavenumbers of the padded periodic grid, one broadcastable array per axis
+        
+        """
+        
+        dim = len(coords)
+        
+        if dim in self._grids:
+            return self._grids[dim]
+        
+        spacing = []
+        for ele in coords:
+            dx = np.diff(ele)
+            if len(dx) > 0 and not np.allclose(dx, dx[0]):
+                raise ValueError("SpectralGaussianField requires regular cell centers!")
+            spacing.append(dx[0] if len(dx) > 0 else 1.)
+        
+        # Largest range of the parameter space, so all draws share one grid
+        range_max = max(np.max(ele) for ele in ranges)
+        
+        shape = [
+            fft.next_fast_len(max(2 * (len(ele) - 1), len(ele) + int(np.ceil(self.padding * range_max / dx))))
+            for ele, dx in zip(coords, spacing)
+            ]
+        
+        wavenumbers = [
+            (2 * np.pi * np.fft.fftfreq(n, dx)).reshape([-1 if count == axis else 1 for count in range(dim)])
+            for axis, (n, dx) in enumerate(zip(shape, spacing))
+            ]
+        
+        self._grids[dim] = (wavenumbers, np.prod(spacing), int(np.prod(shape)))
+        
+        return self._grids[dim]
+    
+    
+    def _spectrum(self, theta, ranges, coords):
+        """
+        
+        Square root of the circulant embedding spectrum of a unit variance Gaussian model.
+        
+        The model is exp(-h^T Q h), where Q follows from the ranges and rotation 
+        of gstools, and its spectral density is pi^(d/2) det(Q)^(-1/2) exp(-k^T Q^-1 k / 4).
+        
+        """
+        
+        dim = len(coords)
+        wavenumbers, cell_volume, size = self._grid(ranges, coords)
+        
+        if dim == 3:
+            model = gs.Gaussian(
+                dim = 3, 
+                var = 1., 
+                len_scale = [theta[2], theta[3], theta[4]], 
+                angles = [theta[5] * np.pi/180, theta[6] * np.pi/180],
+                )
+        else:
+            model = gs.Gaussian(
+                dim = 2, 
+                var = 1., 
+                len_scale = [theta[2], theta[3]], 
+                angles = [theta[4] * np.pi/180],
+                )
+        
+        # Quadratic form of the covariance in the grid coordinates
+        M = model.isometrize(np.eye(dim))
+        Q = np.pi / 4 * M.T @ M / model.len_scale**2
+        Q_inv = np.linalg.inv(Q)
+        
+        exponent = 0
+        for i in range(dim):
+            for j in range(dim):
+                exponent = exponent + Q_inv[i, j] * wavenumbers[i] * wavenumbers[j]
+        
+        density = np.pi**(dim/2) / np.sqrt(np.linalg.det(Q)) * np.exp(-exponent / 4)
+        
+        # Eigenvalues of the circulant covariance, normalized for the unscaled FFT
+        return np.sqrt(density / cell_volume / size).astype(self.dtype)
+    
+    
+    def __getstate__(self):
+        
+        state = self.__dict__.copy()
+        state['_grids'] = {}
+        state['_buffers'] = {}
+        
+        return state
+
+
+
+class PrefetchField(object):
+    """
+    
+    Generate gaussian fields ahead of the sampler in a background thread.
+    
+    The fields do not depend on the current model, so a producer thread 
+    fills a bounded queue while the sampler runs the level set and loss 
+    computations. It is a drop-in replacement of the wrapped field, i.e., 
+    'field_3d' or 'field_2d' return the next queued field.
+    
+    The producer draws from the global NumPy random state concurrently with 
+    the sampler, so runs are not reproducible from a seed.
+    
+    The samplers close the producer at the end of a run, and it restarts on 
+    the next request. It can also be used as a context manager:
+    
+        with PrefetchField(gf, depth=4) as prefetch:
+            ...
+    
+    """
+    
+    
+    def __init__ (self, gaussian_field, depth = 4, dim = 3):
+        
+        """
+    
+        Parameters
+        ----------
+        gaussian_field : GaussianField
+            the field generator to run ahead
+        depth : int, default: 4
+            maximum number of queued fields
+        dim : int, default: 3
+            dimension of the generated fields (2 or 3)
+
+        """
+        
+        if dim not in (2, 3):
+            raise ValueError("'dim' must be 2 or 3!")
+        
+        self.gaussian_field = gaussian_field
+        self.depth = depth
+        self.dim = dim
+        
+        # Time the consumer spent waiting on the queue
+        self.wait_time = 0.
+        self.n_fetched = 0
+        
+        self._queue = None
+        self._thread = None
+        self._stop = None
+        self._pid = None
+    
+    
+    @property
+    def field_3d(self):
+        """
+        
+        Next prefetched 3D gaussian field
+        
+        """
+        
+        assert self.dim == 3, "The prefetched fields are not 3D!"
+        
+        return self._get()
+    
+    
+    @property
+    def field_2d(self):
+        """
+        
+        Next prefetched 2D gaussian field
+        
+        """
+        
+        assert self.dim == 2, "The prefetched fields are not 2D!"
+        
+        return self._get()
+    
+    
+    @property
+    def mean_wait(self):
+        """
+        
+        Average waiting time per field in seconds
+        
+        """
+        
+        return self.wait_time / max(self.n_fetched, 1)
+    
+    
+    def start(self):
+        """
+        
+        Start the producer thread, called on the first request.
+        
+        """
+        
+        # A forked process inherits the thread object but not the thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        
+        # The producer does not reference the prefetcher, so it is collected and closed
+        self._thread = threading.Thread(
+            target = _produce, 
+            args = (self.gaussian_field, self.dim, self._queue, self._stop), 
+            daemon = True,
+            )
+        self._thread.start()
+    
+    
+    def close(self):
+        """
+        
+        Stop the producer thread and discard the queued fields.
+        
+        """
+        
+        if self._thread is None or self._pid != os.getpid():
+            return
+        
+        self._stop.set()
+        
+        # Unblock the producer if the queue is full
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+    
+    
+    def _get(self):
+        
+        self.start()
+        
+        t0 = time.perf_counter()
+        item = self._queue.get()
+        self.wait_time += time.perf_counter() - t0
+        self.n_fetched += 1
+        
+        if isinstance(item, Exception):
+            self._thread.join()
+            self._thread = None
+            raise RuntimeError("Gaussian field generation failed!") from item
+        
+        return item
+    
+    
+    def __getstate__(self):
+        
+        state = self.__dict__.copy()
+        state['_queue'] = state['_thread'] = state['_stop'] = state['_pid'] = None
+        
+        return state
+    
+    
+    def __enter__(self):
+        
+        return self
+    
+    
+    def __exit__(self, *args):
+        
+        self.close()
+    
+    
+    def __del__(self):
+        
+        self.close()
+
+
+
+def _produce(gaussian_field, dim, fields, stop):
+    """
+    
+    Producer of PrefetchField, fills the queue 'fields' until 'stop' is set or the generation fails
+    
+    """
+    
+    name = 'field_3d' if dim == 3 else 'field_2d'
+    
+    while not stop.is_set():
+        
+        try:
+            item = getattr(gaussian_field, name)
+        except Exception as err:
+            item = err
+        
+        while not stop.is_set():
+            try:
+                fields.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        
+        if isinstance(item, Exception):
+            break
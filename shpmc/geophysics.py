@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import hashlib
+import os
+from scipy import sparse
+from shpmc.multiresolution import coarse_shape
+
+
+# Gravitational constant times 1000 kg/m^3 (1 g/cc) in mGal (1e-5 m/s^2) per m
+G_MGAL = 6.6743e-11 * 1e3 * 1e5
+
+
+
+def _log(a, r, b2):
+    """
+
+    ln(a + r) with r**2 = a**2 + b2, stable for a + r close to zero (a < 0)
+
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(a >= 0, np.log(a + r), np.log(b2) - np.log(r - a))
+
+
+
+def _prism_kernels(mesh, receivers, active, kernels, block_size):
+    """
+
+    Sums of the closed-form prism kernels over the 8 corners of every cell.
+
+    The cells are ordered as the C-order flattened model grid (mesh.shape_cells),
+    restricted to the active cells. Each kernel is a function of the corner
+    coordinates relative to the receiver (x, y, z) and their distance r.
+
+    """
+
+    receivers = np.atleast_2d(np.asarray(receivers, dtype=float))
+    nodes = [mesh.nodes_x, mesh.nodes_y, mesh.nodes_z]
+
+    shape = tuple(len(ele) - 1 for ele in nodes)
+    index = np.arange(int(np.prod(shape))) if active is None else np.flatnonzero(np.ravel(active))
+    ijk = np.unravel_index(index, shape)
+
+    # Offsets of exact zeros, e.g., a receiver above a cell edge
+    eps = 1e-10 * min(np.min(np.diff(ele)) for ele in nodes)
+
+    if block_size is None:
+        block_size = max(1, 4_000_000 // max(len(index), 1))
+
+    output = [np.zeros((len(receivers), len(index)), dtype=np.float32) for _ in kernels]
+
+    for start in range(0, len(receivers), block_size):
+
+        rx = receivers[start:start+block_size]
+        values = [np.zeros((len(rx), len(index))) for _ in kernels]
+
+        for corner in range(8):
+
+            # Lower (0) or upper (1) bound of the cell along each axis
+            bits = [(corner >> axis) & 1 for axis in range(3)]
+            sign = (-1) ** (sum(bits) + 1)
+
+            x, y, z = [
+                ele[ijk[axis] + bits[axis]][None, :] - rx[:, axis, None]
+                for axis, ele in enumerate(nodes)
+                ]
+            x, y, z = [np.where(ele == 0, eps, ele) for ele in (x, y, z)]
+            r = np.sqrt(x**2 + y**2 + z**2)
+
+            for count, kernel in enumerate(kernels):
+                values[count] += sign * kernel(x, y, z, r)
+
+        for count, ele in enumerate(values):
+            output[count][start:start+block_size] = ele
+
+    return output
+
+
+
+def gravity_sensitivity(mesh, receivers, active = None, block_size = None):
+    """
+
+    Sensitivity of the vertical gravity (positive down) to the density of the cells.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model, coordinates in m with z up
+    receivers : array, dim: N by 3
+        receiver locations (x, y, z), above the cells
+    active : array, default: None
+        boolean mask of the active cells on the model grid (mesh.shape_cells),
+        all cells if None
+    block_size : int, default: None
+        number of receivers computed at once, about 4e6 kernel values if None
+
+    Returns
+    -------
+    array
+        float32 sensitivity in mGal per g/cc, dim: N by the number of (active) cells
+        in C order of the model grid
+
+    """
+
+    kernel = lambda x, y, z, r: x * _log(y, r, x*x + z*z) + y * _log(x, r, y*y + z*z) - z * np.arctan(x * y / (z * r))
+
+    G = _prism_kernels(mesh, receivers, active, [kernel], block_size)[0]
+    G *= G_MGAL
+
+    return G
+
+
+
+def magnetic_sensitivity(mesh, receivers, inclination, declination, field_strength, active = None, block_size = None):
+    """
+
+    Sensitivity of the total magnetic intensity anomaly to the susceptibility of the cells.
+
+    The magnetization is induced by the inducing field only (no remanence and
+    no self-demagnetization), and the anomaly is projected on the direction
+    of the inducing field.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model, coordinates in m with z up
+    receivers : array, dim: N by 3
+        receiver locations (x, y, z), above the cells
+    inclination : float
+        inclination of the inducing field in degrees, positive downward
+    declination : float
+        declination of the inducing field in degrees, clockwise from north (y)
+    field_strength : float
+        strength of the inducing field in nT
+    active : array, default: None
+        boolean mask of the active cells on the model grid, all cells if None
+    block_size : int, default: None
+        number of receivers computed at once, about 4e6 kernel values if None
+
+    Returns
+    -------
+    array
+        float32 sensitivity in nT per SI susceptibility, dim: N by the number of
+        (active) cells in C order of the model grid
+
+    """
+
+    inclination, declination = inclination * np.pi/180, declination * np.pi/180
+    t = np.array([np.cos(inclination) * np.sin(declination), np.cos(inclination) * np.cos(declination), -np.sin(inclination)])
+
+    # Second derivatives of the volume integral of 1/r
+    kernels = [
+        lambda x, y, z, r: -np.arctan(y * z / (x * r)),
+        lambda x, y, z, r: -np.arctan(x * z / (y * r)),
+        lambda x, y, z, r: -np.arctan(x * y / (z * r)),
+        lambda x, y, z, r: _log(z, r, x*x + y*y),
+        lambda x, y, z, r: _log(y, r, x*x + z*z),
+        lambda x, y, z, r: _log(x, r, y*y + z*z),
+        ]
+
+    Txx, Tyy, Tzz, Txy, Txz, Tyz = _prism_kernels(mesh, receivers, active, kernels, block_size)
+
+    G = t[0]**2 * Txx + t[1]**2 * Tyy + t[2]**2 * Tzz + 2 * (t[0]*t[1] * Txy + t[0]*t[2] * Txz + t[1]*t[2] * Tyz)
+    G *= field_strength / (4 * np.pi)
+
+    return G.astype(np.float32, copy=False)
+
+
+
+def load_sensitivity(kind, mesh, receivers, active = None, cache_dir = '.shpmc_cache', threshold = None, **kwargs):
+    """
+
+    Sensitivity of a survey, computed once and cached on disk.
+
+    The cache key is the hash of the mesh, receivers, active cells and
+    parameters, so later runs and worker processes memory-map the cached
+    matrix instead of computing it.
+
+    Parameters
+    ----------
+    kind : str
+        'gravity' or 'magnetic'
+    mesh : discretize.TensorMesh
+        3D tensor mesh of the model
+    receivers : array, dim: N by 3
+        receiver locations (x, y, z)
+    active : array, default: None
+        boolean mask of the active cells on the model grid
+    cache_dir : str, default: '.shpmc_cache'
+        directory of the cached matrices
+    threshold : float, default: None
+        compress the matrix by dropping the entries smaller than 'threshold' times
+        the largest entry of their row, and store it as a sparse matrix.
+        Dense if None.
+    **kwargs :
+        parameters of gravity_sensitivity or magnetic_sensitivity, e.g., inclination,
+        declination and field_strength
+
+    Returns
+    -------
+    array or scipy.sparse.csr_matrix
+        float32 sensitivity, a read-only memory-mapped array if dense
+
+    """
+
+    compute = {'gravity': gravity_sensitivity, 'magnetic': magnetic_sensitivity}[kind]
+
+    receivers = np.atleast_2d(np.asarray(receivers, dtype=float))
+
+    digest = hashlib.sha1()
+    digest.update(kind.encode())
+    for ele in [*mesh.h, mesh.origin, receivers]:
+        digest.update(np.ascontiguousarray(ele, dtype=float).tobytes())
+    if active is not None:
+        digest.update(np.packbits(np.ravel(active)).tobytes())
+    digest.update(repr((threshold, sorted(kwargs.items()))).encode())
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, '{}.{}'.format(kind, digest.hexdigest()[:16]))
+
+    if threshold is None:
+
+        path += '.npy'
+
+        if not os.path.exists(path):
+            _save(path, np.save, compute(mesh, receivers, active=active, **kwargs))
+
+        return np.load(path, mmap_mode='r')
+
+    path += '.npz'
+
+    if not os.path.exists(path):
+
+        G = compute(mesh, receivers, active=active, **kwargs)
+        G[np.abs(G) < threshold * np.abs(G).max(1, keepdims=True)] = 0
+
+        _save(path, sparse.save_npz, sparse.csr_matrix(G))
+
+    return sparse.load_npz(path)
+
+
+
+def _save(path, save, *args):
+    """
+
+    Write to a temporary file first, so concurrent workers never read a partial file.
+
+    """
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(tmp, 'wb') as f:
+        save(f, *args)
+
+    os.replace(tmp, path)
+
+
+
+class GeophysicsConstraint(object):
+    """
+
+    Gravity or magnetic data compared with the forward response of the models.
+
+    The model is the indicator (m >= 0) of the active cells times the
+    property contrast of the target, and its response is one float32
+    matrix-vector product with the sensitivity, computed in blocks of
+    receivers so a memory-mapped matrix is streamed from disk. The loss is
+    the root mean square of the residuals normalized by the uncertainties.
+
+    """
+
+
+    def __init__ (self, sensitivity, observed, uncertainty = 1., contrast = 1., active = None, block_size = 4096):
+
+        """
+
+        Parameters
+        ----------
+        sensitivity : array or scipy.sparse matrix
+            sensitivity of the survey, dim: N by the number of (active) cells, see load_sensitivity
+        observed : array
+            observed data, e.g., the Bouguer anomaly in mGal, after removing the
+            response of the background
+        uncertainty : float or array, default: 1.
+            standard deviation of the data
+        contrast : float, default: 1.
+            density (g/cc) or susceptibility (SI) contrast of the target with the background
+        active : array, default: None
+            boolean mask of the active cells (the columns of the sensitivity) on the model
+            grid, all cells if None
+        block_size : int, default: 4096
+            number of receivers computed at once
+
+        """
+
+        if sparse.issparse(sensitivity):
+            self.sensitivity = sparse.csr_matrix(sensitivity, dtype=np.float32)
+        else:
+            self.sensitivity = sensitivity if sensitivity.dtype == np.float32 else np.asarray(sensitivity, dtype=np.float32)
+
+        self.observed = np.asarray(observed, dtype=float)
+        self.uncertainty = np.asarray(uncertainty, dtype=float)
+        self.contrast = contrast
+        self.active = None if active is None else np.asarray(active, dtype=bool)
+        self.block_size = block_size
+
+        assert self.sensitivity.shape[0] == len(self.observed), "The sensitivity must have one row per datum!"
+
+
+    def _indicators(self, models):
+        """
+
+        Property models of the (active) cells in float32, dim: cells by n
+
+        """
+
+        models = np.asarray(models)
+        models = models.reshape(len(models), -1)
+
+        if self.active is not None:
+            models = models[:, np.ravel(self.active)]
+
+        indicators = models >= 0 if models.dtype != bool else models
+
+        return (indicators.T * np.float32(self.contrast)).astype(np.float32, copy=False)
+
+
+    def _product(self, m):
+        """
+
+        Sensitivity times the property models, in blocks of receivers
+
+        """
+
+        if sparse.issparse(self.sensitivity):
+            return np.asarray(self.sensitivity @ m)
+
+        n = self.sensitivity.shape[0]
+        output = np.empty((n, *m.shape[1:]), dtype=np.float32)
+
+        for start in range(0, n, self.block_size):
+            output[start:start+self.block_size] = self.sensitivity[start:start+self.block_size] @ m
+
+        return output
+
+
+    def forward(self, model_sign_dist):
+        """
+
+        Forward response of one model.
+
+        Parameters
+        ----------
+        model_sign_dist : array
+            signed distance model (or indicator model)
+
+        Returns
+        -------
+        array
+            predicted data
+
+        """
+
+        return self._product(self._indicators(np.asarray(model_sign_dist)[None])[:, 0])
+
+
+    def predict(self, models, chunk_size = 100):
+        """
+
+        Forward responses of stored models, as float32 matrix-matrix products.
+
+        Parameters
+        ----------
+        models : array, h5py dataset or iterable
+            stack of signed distance or indicator models, or chunks of them, e.g.,
+            read_indicators(filename) for the samples of an HDF5 file
+        chunk_size : int, default: 100
+            number of models of an array or dataset computed at once
+
+        Returns
+        -------
+        array
+            predicted data of each model, dim: n by N
+
+        """
+
+        if hasattr(models, 'shape'):
+            chunks = (models[start:start+chunk_size] for start in range(0, len(models), chunk_size))
+        else:
+            chunks = models
+
+        return np.concatenate([self._product(self._indicators(ele)).T for ele in chunks])
+
+
+    def misfit(self, predicted):
+        """
+
+        Root mean square of the residuals normalized by the uncertainties, for each prediction
+
+        """
+
+        residual = (predicted - self.observed) / self.uncertainty
+
+        return np.sqrt(np.mean(residual**2, -1))
+
+
+    def loss(self, model_sign_dist, contribution):
+        """
+
+        Root mean square of the normalized residuals
+
+        """
+
+        return contribution * self.misfit(self.forward(model_sign_dist))
+
+
+    def batch_loss(self, models, contribution):
+        """
+
+        Loss for a stack of models
+
+        """
+
+        return contribution * self.misfit(self.predict(models))
+
+
+    def coarsen(self, factor, shape = None):
+        """
+
+        Geophysics constraint on a grid coarsened by 'factor' cells along every axis.
+
+        The columns of the fine cells are summed for each coarse cell, i.e.,
+        a coarse cell of the target has the response of all its fine cells.
+
+        Parameters
+        ----------
+        factor : int
+            coarsening factor
+        shape : tuple, default: None
+            shape of the fine model grid, the shape of the active cells if None. 
+            The sensitivity has no grid, so it is required without active cells.
+
+        Returns
+        -------
+        GeophysicsConstraint
+
+        """
+
+        if shape is None:
+            if self.active is None:
+                raise ValueError("The shape of the model grid is required without active cells!")
+            shape = self.active.shape
+
+        shape = tuple(shape)
+        index = np.arange(int(np.prod(shape))) if self.active is None else np.flatnonzero(np.ravel(self.active))
+
+        if len(index) != self.sensitivity.shape[1]:
+            raise ValueError("The sensitivity must have one column per (active) cell of the model grid!")
+
+        shape_coarse = coarse_shape(shape, factor)
+        ijk = np.unravel_index(index, shape)
+        cells = np.ravel_multi_index(tuple(ele // factor for ele in ijk), shape_coarse)
+
+        # Aggregation of the fine columns into the coarse cells
+        S = sparse.csr_matrix(
+            (np.ones(len(index), dtype=np.float32), (np.arange(len(index)), cells)),
+            shape = (len(index), int(np.prod(shape_coarse)))
+            )
+
+        return GeophysicsConstraint(
+            self.sensitivity @ S,
+            self.observed,
+            self.uncertainty,
+            self.contrast,
+            None,
+            self.block_size,
+            )
+
+
+    def __getstate__(self):
+
+        # A memory-mapped sensitivity is reopened from its file
+        state = self.__dict__.copy()
+
+        if isinstance(self.sensitivity, np.memmap):
+            state['sensitivity'] = ('memmap', self.sensitivity.filename)
+
+        return state
+
+
+    def __setstate__(self, state):
+
+        if isinstance(state['sensitivity'], tuple):
+            state['sensitivity'] = np.load(state['sensitivity'][1], mmap_mode='r')
+
+        self.__dict__.update(state)
@@ -3,17 +3,70 @@
 
 import numpy as np
 import random
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import traceback
+import pickle
+import os
+from concurrent.futures import wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
 from tqdm import tqdm
 import skfmm
-from shpmc.loss_functions import (
-    loss_function_binary, 
-    model_sign_dist_to_data, 
-    loss_ordinary_procrustes_analysis,
-    find_sketch_cross_section
-    )
+from shpmc.storage import HDF5SampleWriter, write_datasets
+from shpmc.statistics import PosteriorStatistics
+from shpmc.adaptation import StepSizeAdaptation
+from shpmc.diagnostics import ConvergenceMonitor, geometric_summaries
+from shpmc.profiling import StageTimer
+from shpmc.geo_stats import PrefetchField
+from shpmc.constraints import BinaryConstraint, compile_constraints
+from shpmc.multiresolution import coarse_shape, coarsen_model, prolong_model, coarsen_active, coarsen_field
 
 
-def level_set_perturbation(model_sign_dist_current, velocity_field, max_step):
+def signed_distance(model, band = None, active = None):
+    
+    """
+    
+    Signed distance of a level set function, optionally in a narrow band only.
+    
+    Parameters
+    ----------
+    model : array
+        level set function, the zero level set is the boundary
+    band : float, default: None
+        half width of the narrow band in cells. Cells outside the band are 
+        clamped to +/- band with the sign of 'model'.
+    active : array, default: None
+        boolean mask of the active cells, e.g., below topography. The inactive cells 
+        are excluded from the fast marching and set to NaN.
+
+    Returns
+    -------
+    model_sign_dist : array
+        signed distance, of the same floating point type as 'model'
+
+    """
+    
+    # scikit-fmm computes in double precision
+    dtype = model.dtype if np.issubdtype(model.dtype, np.floating) else np.float64
+    
+    if active is not None:
+        model = np.ma.MaskedArray(model, mask = ~active)
+    
+    if band is None and active is None:
+        return skfmm.distance(model).astype(dtype, copy=False)
+    
+    dist = skfmm.distance(model, narrow = 0. if band is None else band)
+    dist = np.where(np.ma.getmaskarray(dist), np.copysign(band or 0., np.ma.getdata(model)), np.ma.getdata(dist))
+    
+    if active is not None:
+        dist[~active] = np.nan
+    
+    return dist.astype(dtype, copy=False)
+
+
+
+def level_set_perturbation(model_sign_dist_current, velocity_field, max_step, band = None, timer = None, workspace = None, active = None):
     
     """
     
@@ -28,39 +81,95 @@ def level_set_perturbation(model_sign_dist_current, velocity_field, max_step):
         a gaussian field
     max_step : float
         a scale parameter to control the degree of model perturbation
+    band : float, default: None
+        half width of the narrow band in cells. Only the cells within the band 
+        are advected and re-initialised, the others are clamped to +/- band.
+    timer : StageTimer, default: None
+        time the 'extension_velocities' and 'distance' stages
+    workspace : dict, default: None
+        reused buffers of the intermediate grids, which are then updated in place
+    active : array, default: None
+        boolean mask of the active cells, only they are advected and re-initialised. 
+        The velocities of the inactive cells are ignored.
 
     Returns
     -------
     model_sign_dist_candidate : array
-        signed distance of the candidate model
+        signed distance of the candidate model, of the same type as the current model
 
     """
     
     ndim = velocity_field.ndim
     
+    phi = model_sign_dist_current
+    if active is not None:
+        phi = np.ma.MaskedArray(phi, mask = ~active)
+    
     # Perturbation
     [_, F_eval] = skfmm.extension_velocities(
-        model_sign_dist_current, 
+        phi, 
         velocity_field, 
         dx = np.ones(ndim), 
-        order = 1
+        order = 1,
+        narrow = 0. if band is None else band
         )
     
+    if timer is not None:
+        timer.lap('extension_velocities')
+    
     # Step size
     step_i  = np.random.uniform(low=0, high=max_step, size=1)[0]
     dt = step_i / np.max(F_eval)
-    delta_phi = dt * F_eval
-    model_update = model_sign_dist_current - delta_phi # Advection
-    model_sign_dist_candidate = skfmm.distance(model_update)
+    
+    if workspace is None:
+        delta_phi = dt * np.ma.filled(F_eval, 0) # No motion outside the narrow band
+        model_update = model_sign_dist_current - delta_phi # Advection
+    
+    else:
+        model_update = _buffer(workspace, 'model_update', model_sign_dist_current.shape, model_sign_dist_current.dtype)
+        np.multiply(np.ma.getdata(F_eval), -dt, out=model_update, casting='same_kind')
+        if np.ma.is_masked(F_eval):
+            model_update[np.ma.getmaskarray(F_eval)] = 0 # No motion outside the narrow band
+        model_update += model_sign_dist_current # Advection
+    
+    model_sign_dist_candidate = signed_distance(model_update, band, active)
+    
+    if timer is not None:
+        timer.lap('distance')
     
     return model_sign_dist_candidate    
 
 
 
-class StochasticLevelSet3D(object):
+def _buffer(workspace, name, shape, dtype):
     
+    """
+    
+    Reused buffer of a workspace, allocated on first use or when the grid changes.
+
+    """
+    
+    buffer = workspace.get(name)
+    
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = workspace[name] = np.empty(shape, dtype=dtype)
+    
+    return buffer
+
+
+
+class StochasticLevelSet(object):
+    """
+    
+    Level set Monte Carlo sampling, applicable to 2D and 3D models.
+    Use StochasticLevelSet2D or StochasticLevelSet3D.
+    
+    """
+    
+    ndim = None
     
-    def __init__ (self, data, model_initial, gaussian_field, max_step, contribution):
+    
+    def __init__ (self, data, model_initial, gaussian_field, max_step, contribution, band = None, dtype = np.float64, active = None):
         
         
         """
@@ -68,15 +177,28 @@ class StochasticLevelSet3D(object):
         Parameters
         ----------
         data : list
-            multiple types of data, e.g., boreholes, outcrops, and geological sketches. Each data is an array.
+            multiple types of data, e.g., boreholes, outcrops, and geological sketches. Binary data are arrays 
+            or BinaryConstraint, and sketches are [shape_reference, ind_, direction] or SketchConstraint.
         model_initial : array
             initial model
-        gaussian_field : array
+        gaussian_field : GaussianField
             gaussian field to guide the model perturbations
         max_step : float
             a scale parameter to control the degree of model perturbation
         contribution : int/float
             hyperparameter controls the contribution of the loss function
+        band : float, default: None
+            half width of the narrow band in cells, the level set is only updated 
+            near the boundary. Observations further than 'band' from the boundary 
+            are evaluated at +/- band in the loss function.
+        dtype : data-type, default: np.float64
+            floating point type of the models, e.g., np.float32 to halve the memory of the 
+            models and samples. Use a gaussian field of the same type.
+        active : array, default: None
+            boolean mask of the active cells on the model grid, e.g., the cells below 
+            topography (ind_active). Only the active cells are perturbed, re-initialised 
+            by fast marching, stored and included in the posterior maps; the inactive 
+            cells of the models are NaN. Binary observations in inactive cells are ignored.
     
     
         """
@@ -92,27 +214,61 @@ class StochasticLevelSet3D(object):
         
         assert len(data) == len(contribution), "The number of data sets and contributions must be the same!"
         
+        for ele in model_initial:
+            assert ele.ndim == self.ndim, "The initial models must be {}D!".format(self.ndim)
+        
         self.data = data
         self.nd = len(data)
-        # self.ndim = model_initial[0].ndim
+        
+        # Observation indices are compiled once for all iterations
+        self.constraints = compile_constraints(data)
+        
+        self.active = None
+        if active is not None:
+            self.active = np.asarray(active, dtype=bool)
+            assert self.active.shape == model_initial[0].shape, "The active cells must be on the model grid!"
+            self.constraints = [ele.restrict(self.active) if isinstance(ele, BinaryConstraint) else ele for ele in self.constraints]
         
         self.model = model_initial
         self.gaussian_field = gaussian_field
         self.max_step = max_step
         self.c = contribution
+        self.band = band
+        self.dtype = np.dtype(dtype)
+        
+        # Reused buffers of level_set_perturbation
+        self._workspace = {}
+    
+    
+    def __getstate__(self):
+        
+        state = self.__dict__.copy()
+        state['_workspace'] = {}
+        
+        return state
+    
+    
+    def __setstate__(self, state):
         
+        self.__dict__.update(state)
+        self._workspace = {}
         
-    def loss_computation(self, model_sign_dist):
+        
+    def loss_computation(self, model_sign_dist, timer = None, index = None):
         
         """
         
         Loss function computation for both binary observations (e.g., boreholes and outcrops) and geological sketches
-        This function is applicable to the 3D case.
 
         Parameters
         ----------
         model_sign_dist_current : array
             signed distance of the current model
+        timer : StageTimer, default: None
+            time the loss of each data set, as stages 'loss_0', 'loss_1', ...
+        index : list, default: None
+            data sets to evaluate, e.g., the screening data sets of delayed acceptance. 
+            All data sets if None; the loss values of the others are zero.
 
         Returns
         -------
@@ -125,42 +281,63 @@ class StochasticLevelSet3D(object):
         
         loss_individual = np.zeros(self.nd)
         
-        for count, ele in enumerate(self.data):
+        # Binary observations (e.g., drillholes and outcrops) and geological sketches
+        for count, ele in enumerate(self.constraints):
             
-            # Geological sketch
-            if isinstance(ele, list):
-                
-                # Extract model profile to compare with the geological sketch
-                comparision_shape = find_sketch_cross_section(
-                    model = model_sign_dist, 
-                    ind_ = ele[1], 
-                    direction = ele[2]
-                    )
-                
-                # Difference between reference shape (i.e., geological sketch) and comparison shape
-                dist_procrustes, Z, translation = loss_ordinary_procrustes_analysis(ele[0], comparision_shape, self.c[count])
-                loss_individual[count] = dist_procrustes
-        
-            # Binary observations, such as drillholes and outcrops
-            else:
-                obs, obs_sign_dist, obs_sign_dist_contact = model_sign_dist_to_data(
-                    model_sign_dist, 
-                    ele
-                    )
+            if index is not None and count not in index:
+                continue
             
-                loss_individual[count] = loss_function_binary(
-                    obs, 
-                    obs_sign_dist, 
-                    obs_sign_dist_contact, 
-                    self.c[count]
-                    )
+            loss_individual[count] = ele.loss(model_sign_dist, self.c[count])
+            
+            if timer is not None:
+                timer.lap('loss_{}'.format(count))
 
         loss_total = np.sum(loss_individual)
         
         return loss_total, loss_individual
 
 
-    def mcmc_sampling_single_chain(self, iter_num, temperature = 1):
+    def velocity_field(self):
+        
+        """
+        
+        Draw a gaussian field of the model dimension
+
+        Returns
+        -------
+        array
+            a gaussian field and the parameters
+
+        """
+        
+        if self.ndim == 3:
+            return self.gaussian_field.field_3d
+        
+        return self.gaussian_field.field_2d
+
+
+    def mcmc_sampling_single_chain(
+            self, 
+            iter_num, 
+            temperature = 1, 
+            progress = True, 
+            sink = None, 
+            burn_in = 0, 
+            thin = 1, 
+            store_models = True, 
+            output_summary = False,
+            target_acceptance = None,
+            stopping = None,
+            sink_options = None,
+            run_length = False,
+            screening = None,
+            checkpoint = None,
+            checkpoint_interval = 1000,
+            callback = None,
+            show_timings = False,
+            exchange = None,
+            resume_state = None,
+            ):
         
         """
     
@@ -170,54 +347,1197 @@ class StochasticLevelSet3D(object):
             iteration number
         temperature : int
             temeprature value to relax loss function and improve acceptance ratio
+        progress : bool, default: True
+            show the tqdm progress bar
+        sink : str or HDF5SampleWriter, default: None
+            stream the sampled models to an HDF5 file instead of keeping them in memory. 
+            The writer is closed after the loss values, acceptance count and posterior maps are written.
+        sink_options : dict, default: None
+            options of the HDF5SampleWriter created for a file name sink, e.g., 
+            {'packed': True, 'quantize': 'int8'} to store bit-packed indicators
+        run_length : bool, default: False
+            store each distinct kept model once, i.e., a rejected proposal does not store a 
+            copy of the current model. The number of kept iterations of each stored model 
+            ('multiplicity') and its first and last kept iteration ('iterations') are in the 
+            summary and written to the sink; use them as weights of the stored models.
+        screening : list, default: None
+            indices of the cheap data sets (e.g., [0] for the drillholes) of two-stage delayed 
+            acceptance. A candidate is first accepted or rejected on these data sets alone, 
+            and the other data sets are only evaluated for the candidates passing the first 
+            stage; the second stage corrects the acceptance, so the chain targets the same 
+            posterior. The rejections of each stage are in the summary ('rejections') and 
+            written to the sink.
+        burn_in : int, default: 0
+            number of initial iterations excluded from the stored models and posterior statistics
+        thin : int, default: 1
+            keep every 'thin'-th model after the burn-in
+        store_models : bool, default: True
+            store the kept models, set False to keep the posterior statistics only
+        output_summary : bool, default: False
+            output a summary with the running posterior statistics ('posterior'), the time 
+            of each stage ('timings', see StageTimer.summary, with the wait on a PrefetchField 
+            as 'prefetch_wait'), the last model of the chain ('model_sign_dist') and, if the 
+            step is adapted, the adaptation trace ('adaptation')
+        target_acceptance : float, default: None
+            tune max_step during burn-in towards this acceptance rate (e.g., 0.3), 
+            see StepSizeAdaptation. The step is frozen after burn-in, so it requires 
+            burn_in > 1.
+        stopping : ConvergenceMonitor, default: None
+            trace the total loss and geometric summaries, and stop as soon as the stopping 
+            rule is met. The diagnostics are in the summary ('diagnostics').
+        checkpoint : str, default: None
+            file of the checkpoints, written every 'checkpoint_interval' iterations and at 
+            the end of the run, see resume. Every checkpoint rewrites the models stored in 
+            memory, so they are limited to CHECKPOINT_MODELS_MB; use a sink for longer runs, 
+            the checkpoints then only flush it.
+        checkpoint_interval : int, default: 1000
+            number of iterations between the checkpoints
+        callback : callable, default: None
+            called after every iteration with a dictionary of the iteration number ('iteration'), 
+            the time of each stage in s ('timings'), whether the candidate was accepted 
+            ('accepted'), the acceptance count ('acceptance_count') and the total and individual 
+            loss values of the current model ('loss_total', 'loss_individual')
+        show_timings : bool, default: False
+            show the mean time of each stage per iteration in the tqdm postfix
+        exchange : callable, default: None
+            called every 'exchange.interval' iterations with the current model, total loss and 
+            loss values, returns the state to continue from. Used by the replicas of 
+            mcmc_sampling_parallel_tempering.
+        resume_state : dict, default: None
+            state of the chain loaded from a checkpoint, see resume
             
         Returns
         -------
         list
-            outputs from the sampling
+            outputs from the sampling, the sampled models are None if a sink is used or 
+            'store_models' is False. The loss values are recorded for all iterations, 
+            up to the iteration where the stopping rule is met.
             
         """
         
         assert len(self.model) == 1, "Single chain can only have one initial model!"
         
+        _check_adaptation(target_acceptance, burn_in)
+        
+        assert checkpoint is None or (exchange is None and (stopping is None or isinstance(stopping, ConvergenceMonitor))), \
+            "Checkpoints are only available for a single chain!"
+        
+        if isinstance(sink, str):
+            sink = HDF5SampleWriter(sink, active = self.active, **(sink_options or {}))
+        
+        shape = self.model[0].shape
+        
         # Initialization
-        sample_models = np.zeros((iter_num, *self.model[0].shape))
+        if store_models and sink is None:
+            sample_models = np.zeros((len(range(burn_in, iter_num, thin)), *shape), dtype=self.dtype)
+        else:
+            sample_models = None
+        
+        if checkpoint is not None and sample_models is not None and sample_models.nbytes > CHECKPOINT_MODELS_MB * 2**20:
+            raise ValueError(
+                "Checkpoints rewrite the models stored in memory ({:.0f} MB), use a sink or store_models=False!".format(
+                    sample_models.nbytes / 2**20))
+            
         loss_values = np.zeros((iter_num, self.nd))
+        statistics = PosteriorStatistics(shape, self.nd, self.active)
+        n_stored = 0
         
-        model_sign_dist_current = skfmm.distance(self.model[0])
+        # Run-length weights of the stored models
+        multiplicity, iterations = [], []
+        stored_model = None
+        
+        model_sign_dist_current = signed_distance(np.asarray(self.model[0], dtype=self.dtype), self.band, self.active)
         loss_total_current, loss_individual_current = self.loss_computation(model_sign_dist_current)
         
         # Storing initials
         loss_values[0, :] = loss_individual_current
-        sample_models[0, :] = model_sign_dist_current
+        
+        if burn_in == 0 and resume_state is None:
+            statistics.update(model_sign_dist_current, loss_values[0, :])
+            
+            if store_models:
+                if sink is None:
+                    sample_models[n_stored, :] = model_sign_dist_current
+                else:
+                    sink.append(model_sign_dist_current)
+                n_stored += 1
+                
+                if run_length:
+                    multiplicity.append(1)
+                    iterations.append([0, 0])
+                    stored_model = model_sign_dist_current
         
         acceptance_count = 1
         
-        for ii in tqdm(np.arange(iter_num-1)):
+        # Rejections of the screening and full stage of delayed acceptance
+        rejections = np.zeros(2, dtype=int)
+        
+        if screening is not None:
+            screening = list(screening)
+            remaining = [k for k in range(self.nd) if k not in screening]
+            assert len(screening) > 0 and len(remaining) > 0, "Screen the candidates on some, but not all, data sets!"
+        
+        max_step = self.max_step
+        adaptation = StepSizeAdaptation(max_step, target_acceptance) if target_acceptance is not None else None
+        
+        # Traces of the convergence diagnostics
+        if stopping is not None and resume_state is None:
+            trace = stopping.allocate(iter_num, 1 + 1 + len(shape), burn_in)
+            trace[0, 0], trace[0, 1:] = loss_total_current, geometric_summaries(model_sign_dist_current, self.active)
+            trace_model = model_sign_dist_current
+        
+        start = 0
+        
+        # Continue from a checkpoint
+        if resume_state is not None:
+            
+            start = resume_state['iteration']
+            
+            model_sign_dist_current = resume_state['model_sign_dist']
+            loss_total_current = resume_state['loss_total']
+            acceptance_count = resume_state['acceptance_count']
+            statistics = resume_state['statistics']
+            n_stored = resume_state['n_stored']
+            max_step = resume_state['max_step']
+            adaptation = resume_state['adaptation']
+            rejections = np.array(resume_state.get('rejections', rejections))
+            
+            multiplicity = list(resume_state.get('multiplicity', []))
+            iterations = [list(ele) for ele in resume_state.get('iterations', [])]
+            if resume_state.get('stored_current', False):
+                stored_model = model_sign_dist_current
+            
+            loss_values[:start+1] = resume_state['loss_values']
+            
+            if sample_models is not None:
+                sample_models[:n_stored] = resume_state['sample_models']
+            
+            if stopping is not None:
+                trace = np.zeros((iter_num, 1 + 1 + len(shape)))
+                trace[:start+1] = resume_state['trace']
+                trace_model = model_sign_dist_current
+            
+            np.random.set_state(resume_state['random_state'])
+            random.setstate(resume_state['python_random_state'])
+        
+        def save_checkpoint(iteration):
+            
+            if sink is not None:
+                sink.flush()
+            
+            _save_checkpoint(checkpoint, {
+                'options': {
+                    'iter_num': iter_num,
+                    'temperature': temperature,
+                    'burn_in': burn_in,
+                    'thin': thin,
+                    'store_models': store_models,
+                    'target_acceptance': target_acceptance,
+                    'run_length': run_length,
+                    'screening': screening,
+                    'checkpoint_interval': checkpoint_interval,
+                    },
+                'iteration': iteration,
+                'model_sign_dist': model_sign_dist_current,
+                'loss_total': loss_total_current,
+                'loss_values': loss_values[:iteration+1],
+                'acceptance_count': acceptance_count,
+                'statistics': statistics,
+                'n_stored': n_stored,
+                'sample_models': sample_models[:n_stored] if sample_models is not None else None,
+                'multiplicity': list(multiplicity),
+                'iterations': [list(ele) for ele in iterations],
+                'stored_current': stored_model is not None and stored_model is model_sign_dist_current,
+                'sink': _sink_options(sink),
+                'max_step': max_step,
+                'adaptation': adaptation,
+                'rejections': rejections.copy(),
+                'stopping': stopping,
+                'trace': trace[:iteration+1] if stopping is not None else None,
+                'random_state': np.random.get_state(),
+                'python_random_state': random.getstate(),
+                })
+        
+        n_iter = iter_num
+        
+        timer = StageTimer()
+        bar = tqdm(np.arange(start, iter_num-1), initial = start, total = iter_num-1, disable = not progress)
+        
+        try:
+            for ii in bar:
+                
+                timer.start()
+            
+                # Create velocity fields, the wait on a PrefetchField is a stage of its own
+                wait_time = getattr(self.gaussian_field, 'wait_time', None)
+                velocity_field, theta = self.velocity_field()
+                timer.lap('velocity_field')
+                    
+                if wait_time is not None:
+                    timer.move('velocity_field', 'prefetch_wait', self.gaussian_field.wait_time - wait_time)
+                
+                # Model perturbation
+                model_sign_dist_candidate = level_set_perturbation(model_sign_dist_current, velocity_field, max_step, self.band, timer, self._workspace, self.active)
+                
+                # Loss function
+                if screening is None:
+                    
+                    loss_total_candidate, loss_individual_candidate = self.loss_computation(model_sign_dist_candidate, timer)
+                    
+                    acceptance_ratio = (loss_total_current**2 - loss_total_candidate**2) / temperature
+                    accepted = np.log(np.random.uniform(0, 1)) <= acceptance_ratio
+                    
+                    if not accepted:
+                        rejections[1] += 1
+                
+                # Delayed acceptance, screen the candidate on the cheap data sets first
+                else:
+                    
+                    _, loss_individual_candidate = self.loss_computation(model_sign_dist_candidate, timer, screening)
+                    
+                    loss_screen_current = np.sum(loss_values[ii, screening])
+                    loss_screen_candidate = np.sum(loss_individual_candidate[screening])
+                    
+                    acceptance_ratio = (loss_screen_current**2 - loss_screen_candidate**2) / temperature
+                    accepted = np.log(np.random.uniform(0, 1)) <= acceptance_ratio
+                    
+                    if not accepted:
+                        rejections[0] += 1
+                    
+                    # Correct with the full loss
+                    else:
+                        loss_individual_candidate += self.loss_computation(model_sign_dist_candidate, timer, remaining)[1]
+                        loss_total_candidate = np.sum(loss_individual_candidate)
+                        
+                        correction = (loss_total_current**2 - loss_total_candidate**2) / temperature - acceptance_ratio
+                        accepted = np.log(np.random.uniform(0, 1)) <= correction
+                        
+                        # Log of the overall acceptance probability
+                        acceptance_ratio = min(acceptance_ratio, 0) + min(correction, 0)
+                        
+                        if not accepted:
+                            rejections[1] += 1
+                
+                # Tune the step during burn-in
+                if adaptation is not None and ii+1 < burn_in:
+                    max_step = adaptation.update(acceptance_ratio)
+                
+                # Accept
+                if accepted:
+                    loss_values[ii+1, :] = loss_individual_candidate
+                    acceptance_count += 1
+                    model_sign_dist_current = model_sign_dist_candidate
+                    loss_total_current = loss_total_candidate
+                
+                # Reject
+                else:
+                    loss_values[ii+1, :] = loss_values[ii, :]
+                
+                timer.lap('acceptance')
+                
+                # Replica exchange
+                if exchange is not None and (ii+1) % exchange.interval == 0:
+                    model_sign_dist_current, loss_total_current, loss_values[ii+1, :] = exchange(
+                        model_sign_dist_current, loss_total_current, loss_values[ii+1, :])
+                    timer.lap('exchange')
+                
+                # Keep the samples after burn-in
+                if ii+1 >= burn_in and (ii+1 - burn_in) % thin == 0:
+                    statistics.update(model_sign_dist_current, loss_values[ii+1, :])
+                    
+                    # The model is unchanged since it was stored
+                    if store_models and run_length and model_sign_dist_current is stored_model:
+                        multiplicity[-1] += 1
+                        iterations[-1][1] = ii+1
+                    
+                    elif store_models:
+                        if sink is None:
+                            sample_models[n_stored, :] = model_sign_dist_current
+                        else:
+                            sink.append(model_sign_dist_current)
+                        n_stored += 1
+                        
+                        if run_length:
+                            multiplicity.append(1)
+                            iterations.append([ii+1, ii+1])
+                            stored_model = model_sign_dist_current
+                    
+                    timer.lap('storage')
+                
+                # Convergence diagnostics
+                stop = False
+                
+                if stopping is not None:
+                    
+                    # Geometric summaries change only with the model
+                    if model_sign_dist_current is not trace_model:
+                        trace[ii+1, 1:] = geometric_summaries(model_sign_dist_current, self.active)
+                        trace_model = model_sign_dist_current
+                    else:
+                        trace[ii+1, 1:] = trace[ii, 1:]
+                    
+                    trace[ii+1, 0] = loss_total_current
+                    
+                    stop = stopping.update(trace[None], ii+2)
+                    timer.lap('diagnostics')
+                
+                if checkpoint is not None and (ii+1) % checkpoint_interval == 0 and not stop:
+                    save_checkpoint(ii+1)
+                    timer.lap('checkpoint')
+                
+                timings = timer.end()
+                
+                if callback is not None:
+                    callback({
+                        'iteration': int(ii+1),
+                        'timings': timings,
+                        'accepted': bool(accepted),
+                        'acceptance_count': acceptance_count,
+                        'loss_total': loss_total_current,
+                        'loss_individual': loss_values[ii+1, :],
+                        })
+                
+                if show_timings and progress:
+                    bar.set_postfix(timer.postfix(), refresh = False)
+                
+                if stop:
+                    n_iter = ii+2
+                    break
+        
+        # Also on errors and interrupts
+        finally:
+            bar.close()
+            
+            # Stop the producer thread of a PrefetchField, it restarts on the next run
+            if isinstance(self.gaussian_field, PrefetchField):
+                self.gaussian_field.close()
+        
+        # The final state, e.g., to extend the chain later
+        if checkpoint is not None:
+            save_checkpoint(n_iter-1)
+        
+        loss_values = loss_values[:n_iter]
+        if sample_models is not None:
+            sample_models = sample_models[:n_stored]
+        
+        if run_length:
+            multiplicity = np.array(multiplicity, dtype=np.int64)
+            iterations = np.array(iterations, dtype=np.int64).reshape(-1, 2)
+        
+        if sink is not None:
+            datasets = {'posterior/' + key: value for key, value in statistics.to_dict().items()}
+            if run_length:
+                datasets.update({'multiplicity': multiplicity, 'iterations': iterations})
+            if adaptation is not None:
+                datasets.update({'adaptation/' + key: value for key, value in adaptation.to_dict().items()})
+            if isinstance(stopping, ConvergenceMonitor):
+                datasets.update({'diagnostics/' + key: value for key, value in stopping.to_dict().items()})
+            if screening is not None:
+                datasets['rejections'] = rejections
+            sink.close(loss = loss_values, acceptance = acceptance_count, **datasets)
+        
+        if output_summary:
+            summary = {'posterior': statistics, 'timings': timer.summary(), 'model_sign_dist': model_sign_dist_current}
+            if run_length:
+                summary['multiplicity'] = multiplicity
+                summary['iterations'] = iterations
+            if screening is not None:
+                summary['rejections'] = rejections
+            if adaptation is not None:
+                summary['adaptation'] = adaptation
+            if isinstance(stopping, ConvergenceMonitor):
+                summary['diagnostics'] = stopping
+            return loss_values, sample_models, acceptance_count, summary
+    
+        return loss_values, sample_models, acceptance_count
+    
+
+    def resume(self, checkpoint, iter_num = None, progress = True, output_summary = False):
+        
+        """
+        
+        Continue a single chain from its last checkpoint.
+        
+        The chain continues bit-for-bit as if it had not been interrupted: the 
+        model, loss values, statistics, step adaptation, diagnostics and the 
+        NumPy and random generator states are restored, and the sampled models 
+        are appended to the same HDF5 file after cutting the samples written 
+        since the checkpoint. The gaussian field must draw from the global 
+        NumPy random state, i.e., not a PrefetchField, for the run to be 
+        reproduced exactly.
+    
+        Parameters
+        ----------
+        checkpoint : str
+            checkpoint file written by mcmc_sampling_single_chain, it is updated as the chain continues
+        iter_num : int, default: None
+            total iteration number, e.g., larger than the original one to extend a 
+            finished chain. The original iteration number if None.
+        progress : bool, default: True
+            show the tqdm progress bar
+        output_summary : bool, default: False
+            see mcmc_sampling_single_chain
+            
+        Returns
+        -------
+        list
+            outputs from the whole chain, see mcmc_sampling_single_chain
+            
+        """
+        
+        with open(checkpoint, 'rb') as f:
+            state = pickle.load(f)
+        
+        options = state['options']
+        
+        if iter_num is not None:
+            assert iter_num > state['iteration'], "The chain already has {} iterations!".format(state['iteration']+1)
+            options['iter_num'] = iter_num
+        
+        sink = None
+        if state['sink'] is not None:
+            sink = HDF5SampleWriter(resume = state['n_stored'], **state['sink'])
+        
+        return self.mcmc_sampling_single_chain(
+            progress = progress, 
+            sink = sink, 
+            output_summary = output_summary, 
+            stopping = state['stopping'],
+            checkpoint = checkpoint, 
+            resume_state = state, 
+            **options
+            )
+    
+
+    def mcmc_sampling_multiresolution(self, iter_num, levels, temperature = 1, progress = True, output_summary = False, **kwargs):
         
-            # Create velocity fields
-            velocity_field, theta = self.gaussian_field.field_3d
+        """
+        
+        Coarse-to-fine sampling of a single chain.
+        
+        The chain starts on the grid coarsened by the first factor of 'levels', 
+        with the data, active cells and gaussian field mapped to it, and runs 
+        the iterations of the level as burn-in. The last model is prolonged to 
+        the next, finer level and the chain continues, up to the model grid 
+        where it runs as mcmc_sampling_single_chain. A step on a grid coarsened 
+        by a factor of 4 costs about 1/64 of a step on the 3D model grid.
+        
+        The step size is in cells of each level, so the coarse levels take 
+        larger steps. Custom constraints must implement coarsen(factor, shape), 
+        as BinaryConstraint and SketchConstraint do.
+    
+        Parameters
+        ----------
+        iter_num : int
+            iteration number on the model grid
+        levels : list
+            (factor, iteration number) of each coarse level, from the coarsest one, 
+            e.g., [(4, 2000), (2, 1000)]. Every factor must be a multiple of the next one.
+        temperature : int
+            temeprature value to relax loss function and improve acceptance ratio, for all levels
+        progress : bool, default: True
+            show the tqdm progress bar
+        output_summary : bool, default: False
+            output the summary of mcmc_sampling_single_chain with the loss values, acceptance 
+            count and summary of each coarse level ('levels')
+        **kwargs : 
+            options of mcmc_sampling_single_chain on the model grid, e.g., sink, burn_in 
+            and thin. 'target_acceptance' also tunes the step of the coarse levels, and 
+            requires burn_in > 1 on the model grid.
+            
+        Returns
+        -------
+        list
+            outputs from the sampling on the model grid, see mcmc_sampling_single_chain
+            
+        """
+        
+        assert len(self.model) == 1, "Multiresolution sampling runs a single chain!"
+        
+        factors = [ele[0] for ele in levels] + [1]
+        for count in range(len(levels)):
+            assert factors[count] > factors[count+1] and factors[count] % factors[count+1] == 0, \
+                "Every factor must be a multiple of the next one!"
+        
+        _check_adaptation(kwargs.get('target_acceptance'), kwargs.get('burn_in', 0))
+        
+        shape = self.model[0].shape
+        model = coarsen_model(self.model[0], factors[0])
+        
+        outputs = []
+        
+        for count, (factor, level_iter_num) in enumerate(levels):
+            
+            # Data, active cells and gaussian field of the level
+            active = coarsen_active(self.active, factor) if self.active is not None else None
+            constraints = [ele.coarsen(factor, shape) for ele in self.constraints]
+            
+            sampler = type(self)(
+                constraints, 
+                [model], 
+                gaussian_field = coarsen_field(self.gaussian_field, factor, active), 
+                max_step = self.max_step, 
+                contribution = self.c, 
+                band = None if self.band is None else self.band / factor, 
+                dtype = self.dtype, 
+                active = active,
+                )
+            
+            loss_values, _, acceptance_count, summary = sampler.mcmc_sampling_single_chain(
+                level_iter_num, 
+                temperature = temperature, 
+                progress = progress, 
+                burn_in = level_iter_num, 
+                store_models = False, 
+                output_summary = True, 
+                target_acceptance = kwargs.get('target_acceptance'),
+                )
+            
+            outputs.append({
+                'factor': factor, 
+                'loss_values': loss_values, 
+                'acceptance_count': acceptance_count, 
+                'summary': summary,
+                })
+            
+            # Prolong the last model to the next level
+            ratio = factor // factors[count+1]
+            model = prolong_model(summary['model_sign_dist'], coarse_shape(shape, factors[count+1]), ratio)
+        
+        sampler = copy.copy(self)
+        sampler.model = [model.astype(self.dtype, copy=False)]
+        
+        results = sampler.mcmc_sampling_single_chain(
+            iter_num, 
+            temperature = temperature, 
+            progress = progress, 
+            output_summary = output_summary, 
+            **kwargs
+            )
+        
+        if output_summary:
+            results[3]['levels'] = outputs
+        
+        return results
+    
+
+    def mcmc_sampling_multi_chain(
+            self, 
+            iter_num, 
+            temperature = 1, 
+            n_workers = None, 
+            seed = None, 
+            sink = None, 
+            burn_in = 0, 
+            thin = 1, 
+            store_models = True, 
+            output_summary = False,
+            target_acceptance = None,
+            stopping = None,
+            sink_options = None,
+            run_length = False,
+            screening = None,
+            ):
+        
+        """
+        
+        Run one chain per initial model on a process pool.
+        
+        The sampler is sent once to every worker with the compiled constraints,
+        i.e., the observed cells only, not the data grids. Every chain seeds the
+        NumPy and random generators of its worker from an independent stream
+        spawned from 'seed'.
+    
+        Parameters
+        ----------
+        iter_num : int
+            iteration number of each chain
+        temperature : int
+            temeprature value to relax loss function and improve acceptance ratio
+        n_workers : int, default: None
+            number of worker processes, defaults to the number of CPUs
+        seed : int, default: None
+            seed of the parent random stream, a fresh one is drawn if None
+        sink : str, default: None
+            file name pattern, e.g., 'output_sampling_chain_{}.h5', formatted with 
+            the chain number (starting from 1) to stream each chain to its own file
+        burn_in, thin, store_models, target_acceptance, sink_options : 
+            see mcmc_sampling_single_chain
+        run_length : bool, default: False
+            store each distinct model of a chain once, see mcmc_sampling_single_chain. 
+            The in-memory models are a list with one array per chain, and the weights 
+            are in the summaries of the chains.
+        screening : list, default: None
+            cheap data sets of delayed acceptance, see mcmc_sampling_single_chain
+        stopping : ConvergenceMonitor, default: None
+            stop all chains as soon as the stopping rule is met for the chains together. 
+            The chains write their traces to shared memory and the main process checks 
+            the rule, so all chains must run at once (n_workers >= number of chains).
+        output_summary : bool, default: False
+            output a summary with the posterior statistics pooled over the chains 
+            ('posterior'), the summaries of each chain ('chains') and the diagnostics 
+            ('diagnostics') if 'stopping' is given
+            
+        Returns
+        -------
+        list
+            outputs from the sampling stacked along the first axis (chain), 
+            the sampled models are None if a sink is used or 'store_models' is False. 
+            When the chains are stopped, they are cut to the shortest chain.
+            
+        """
+        
+        n_chain = len(self.model)
+        streams = np.random.SeedSequence(seed).spawn(n_chain)
+        
+        if sink is None:
+            sinks = [None] * n_chain
+        else:
+            sinks = [sink.format(k+1) for k in range(n_chain)]
+        
+        # The workers only evaluate the compiled constraints, the data sets are not sent
+        sampler = copy.copy(self)
+        sampler.data = None
+        sampler.model = []
+        
+        _check_adaptation(target_acceptance, burn_in)
+        
+        blocks = []
+        
+        # Shared traces and stop iteration of the convergence diagnostics
+        if stopping is not None:
+            
+            if n_workers is None:
+                n_workers = n_chain
+            
+            assert n_workers >= n_chain, "All chains must run at once to be stopped together!"
+            
+            n_summary = 1 + 1 + self.model[0].ndim
             
-            # Model perturbation
-            model_sign_dist_candidate = level_set_perturbation(model_sign_dist_current, velocity_field, self.max_step)
+            shm_trace = shared_memory.SharedMemory(create=True, size=n_chain*iter_num*n_summary*8)
+            shm_control = shared_memory.SharedMemory(create=True, size=(n_chain+1)*8)
+            blocks += [shm_trace, shm_control]
             
-            # Loss function
-            loss_total_candidate, loss_individual_candidate = self.loss_computation(model_sign_dist_candidate)
+            traces = np.ndarray((n_chain, iter_num, n_summary), buffer=shm_trace.buf)
+            control = np.ndarray(n_chain+1, dtype=np.int64, buffer=shm_control.buf)
+            control[:n_chain], control[-1] = 0, iter_num
             
-            acceptance_ratio = (loss_total_current**2 - loss_total_candidate**2) / temperature
+            chain_stopping = [
+                _SharedStopping(shm_trace.name, shm_control.name, k, n_chain, iter_num, n_summary) 
+                for k in range(n_chain)
+                ]
+        
+        else:
+            chain_stopping = [None] * n_chain
+        
+        try:
+            with ProcessPoolExecutor(
+                    max_workers = n_workers, 
+                    initializer = _init_chain_worker, 
+                    initargs = (sampler,)
+                    ) as pool:
+                
+                options = {
+                    'iter_num': iter_num,
+                    'temperature': temperature,
+                    'burn_in': burn_in,
+                    'thin': thin,
+                    'store_models': store_models,
+                    'output_summary': True,
+                    'target_acceptance': target_acceptance,
+                    'sink_options': sink_options,
+                    'run_length': run_length,
+                    'screening': screening,
+                    }
+                
+                futures = [
+                    pool.submit(_run_chain, self.model[k], streams[k], sinks[k], dict(options, stopping=chain_stopping[k])) 
+                    for k in range(n_chain)
+                    ]
+                
+                if stopping is not None:
+                    stopping.start(burn_in)
+                
+                stopped = False
+                
+                with tqdm(total = n_chain) as progress:
+                    
+                    pending = futures
+                    while pending:
+                        
+                        done, pending = wait(pending, timeout = None if stopping is None else 0.5, return_when = FIRST_COMPLETED)
+                        progress.update(len(done))
+                        
+                        # Stop all chains a check interval ahead of the leading chain
+                        if stopping is not None and not stopped and stopping.update(traces, control[:n_chain].min()):
+                            control[-1] = min(control[:n_chain].max() + stopping.check_interval, iter_num)
+                            stopped = True
+                
+                outputs = [ele.result() for ele in futures]
+                
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        
+
+        n_iter = min(len(ele[0]) for ele in outputs)
+        loss_values = np.stack([ele[0][:n_iter] for ele in outputs])
+        
+        if store_models and sink is None and run_length:
+            sample_models = [ele[1] for ele in outputs]
+        elif store_models and sink is None:
+            n_stored = min(len(ele[1]) for ele in outputs)
+            sample_models = np.stack([ele[1][:n_stored] for ele in outputs])
+        else:
+            sample_models = None
+        
+        acceptance_count = np.array([ele[2] for ele in outputs])
+        
+        if sink is not None and stopping is not None:
+            diagnostics = {'diagnostics/' + key: value for key, value in stopping.to_dict().items()}
+            for ele in sinks:
+                write_datasets(ele, **diagnostics)
+        
+        if output_summary:
             
-            # Accept
-            if np.log(np.random.uniform(0, 1)) <= acceptance_ratio:
-                loss_values[ii+1, :] = loss_individual_candidate
-                acceptance_count += 1
-                model_sign_dist_current = model_sign_dist_candidate
-                loss_total_current = loss_total_candidate
+            posterior = outputs[0][3]['posterior']
+            for ele in outputs[1:]:
+                posterior = posterior.merge(ele[3]['posterior'])
             
-            # Reject
-            else:
-                loss_values[ii+1, :] = loss_values[ii, :]
+            summary = {'posterior': posterior, 'chains': [ele[3] for ele in outputs]}
+            if stopping is not None:
+                summary['diagnostics'] = stopping
+            
+            return loss_values, sample_models, acceptance_count, summary
+        
+        return loss_values, sample_models, acceptance_count
+
 
-            sample_models[ii+1, :] = model_sign_dist_current
+    def mcmc_sampling_parallel_tempering(
+            self, 
+            iter_num, 
+            temperatures, 
+            swap_interval = 10, 
+            seed = None, 
+            progress = True, 
+            sink = None, 
+            burn_in = 0, 
+            thin = 1, 
+            store_models = True, 
+            output_summary = False,
+            target_acceptance = None,
+            sink_options = None,
+            run_length = False,
+            screening = None,
+            ):
+        
+        """
+        
+        Replica exchange sampling over a temperature ladder.
+        
+        Every temperature runs as a replica in its own process. Every 
+        'swap_interval' iterations, swaps of the states of neighbouring 
+        replicas are proposed, alternating between the even and odd pairs, 
+        and accepted with probability 
+        min(1, exp((L_i**2 - L_j**2) * (1/T_i - 1/T_j))). Only the models of
+        the first replica, i.e., at temperatures[0] (usually 1), are kept.
     
+        Parameters
+        ----------
+        iter_num : int
+            iteration number of each replica
+        temperatures : list
+            increasing temperatures of the replicas, e.g., np.geomspace(1, 20, 6)
+        swap_interval : int, default: 10
+            number of iterations between the swap proposals
+        seed : int, default: None
+            seed of the parent random stream, a fresh one is drawn if None
+        progress : bool, default: True
+            show the tqdm progress bar
+        sink : str, default: None
+            stream the models of the first replica to an HDF5 file, the temperatures 
+            and swap acceptance rates are written next to them
+        burn_in, thin, store_models, sink_options, run_length : 
+            see mcmc_sampling_single_chain, they apply to the first replica
+        target_acceptance : float, default: None
+            tune the step of each replica during burn-in, see mcmc_sampling_single_chain
+        screening : list, default: None
+            cheap data sets of delayed acceptance in every replica, see mcmc_sampling_single_chain
+        output_summary : bool, default: False
+            output a summary with the posterior statistics of the first replica ('posterior'), 
+            the temperatures ('temperatures'), the swap acceptance rate of each neighbouring 
+            pair ('swap_acceptance') and the acceptance count of each replica ('replica_acceptance')
+            
+        Returns
+        -------
+        list
+            outputs from the sampling of the first replica, see mcmc_sampling_single_chain
+            
+        """
+        
+        temperatures = np.asarray(temperatures, dtype=float)
+        n_replica = len(temperatures)
+        
+        assert n_replica > 1, "Parallel tempering needs at least two temperatures!"
+        assert np.all(np.diff(temperatures) > 0), "The temperatures must be increasing!"
+        assert len(self.model) in (1, n_replica), "Provide one initial model, or one per temperature!"
+        
+        assert sink is None or isinstance(sink, str), "The sink must be a file name!"
+        
+        _check_adaptation(target_acceptance, burn_in)
+        
+        models_initial = self.model * n_replica if len(self.model) == 1 else self.model
+        
+        streams = np.random.SeedSequence(seed).spawn(n_replica + 1)
+        rng = np.random.default_rng(streams[-1])
+        
+        # The replicas only evaluate the compiled constraints, the data sets are not sent
+        sampler = copy.copy(self)
+        sampler.data = None
+        sampler.model = []
+        
+        ctx = multiprocessing.get_context()
+        conns, processes = [], []
+        
+        swap_count = np.zeros(n_replica-1, dtype=int)
+        swap_accepted = np.zeros(n_replica-1, dtype=int)
+        
+        try:
+            for k in range(n_replica):
+                
+                options = {
+                    'iter_num': iter_num,
+                    'temperature': temperatures[k],
+                    'burn_in': burn_in,
+                    'thin': thin,
+                    'store_models': store_models and k == 0,
+                    'output_summary': True,
+                    'target_acceptance': target_acceptance,
+                    'sink_options': sink_options if k == 0 else None,
+                    'run_length': run_length and k == 0,
+                    'screening': screening,
+                    }
+                
+                conn, conn_replica = ctx.Pipe()
+                process = ctx.Process(
+                    target = _run_replica, 
+                    args = (conn_replica, sampler, models_initial[k], streams[k], 
+                            sink if k == 0 else None, options, swap_interval),
+                    daemon = True,
+                    )
+                process.start()
+                conn_replica.close()
+                
+                conns.append(conn)
+                processes.append(process)
+            
+            for jj in tqdm(range((iter_num-1) // swap_interval), disable = not progress):
+                
+                loss_total = [_receive(conn) for conn in conns]
+                
+                # Propose swaps of the even or odd neighbouring pairs
+                partner = {}
+                for k in range(jj % 2, n_replica-1, 2):
+                    
+                    swap_count[k] += 1
+                    swap_ratio = (loss_total[k]**2 - loss_total[k+1]**2) * (1/temperatures[k] - 1/temperatures[k+1])
+                    
+                    if np.log(rng.uniform(0, 1)) <= swap_ratio:
+                        swap_accepted[k] += 1
+                        partner[k], partner[k+1] = k+1, k
+                
+                for k, conn in enumerate(conns):
+                    conn.send(k in partner)
+                
+                states = {k: _receive(conns[k]) for k in partner}
+                for k in partner:
+                    conns[k].send(states[partner[k]])
+            
+            outputs = [_receive(conn) for conn in conns]
+            
+            for process in processes:
+                process.join()
+                
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        
+        loss_values, sample_models, acceptance_count, summary = outputs[0]
+        
+        swap_acceptance = swap_accepted / np.maximum(swap_count, 1)
+        
+        if sink is not None:
+            write_datasets(sink, temperatures = temperatures, swap_acceptance = swap_acceptance)
+        
+        if output_summary:
+            
+            summary['temperatures'] = temperatures
+            summary['swap_acceptance'] = swap_acceptance
+            summary['replica_acceptance'] = np.array([ele[2] for ele in outputs])
+            
+            return loss_values, sample_models, acceptance_count, summary
+        
         return loss_values, sample_models, acceptance_count
-    
\ No newline at end of file
+
+
+
+
+class StochasticLevelSet3D(StochasticLevelSet):
+    """
+    
+    Level set Monte Carlo sampling of 3D models, the velocities are drawn 
+    from GaussianField.field_3d.
+    
+    """
+    
+    ndim = 3
+
+
+
+class StochasticLevelSet2D(StochasticLevelSet):
+    """
+    
+    Level set Monte Carlo sampling of 2D models (e.g., fence sections), the 
+    velocities are drawn from GaussianField.field_2d. A geological sketch is 
+    compared with the whole model, e.g., SketchConstraint(sketch_coord, 
+    coordinates=mesh.cell_centers).
+    
+    """
+    
+    ndim = 2
+
+
+
+def _check_adaptation(target_acceptance, burn_in):
+    
+    """
+    
+    The step is only adapted during burn-in, a target acceptance rate without burn-in would be ignored.
+
+    """
+    
+    if target_acceptance is not None and burn_in < 2:
+        raise ValueError("The step is only adapted during burn-in, set burn_in > 1 with target_acceptance!")
+
+
+
+def _sink_options(sink):
+    
+    """
+    
+    Options to reopen the HDF5 file of a sink when resuming a chain.
+
+    """
+    
+    if sink is None:
+        return None
+    
+    return {
+        'filename': sink.filename,
+        'dataset': sink.dataset,
+        'chunk_size': sink.chunk_size,
+        'compression': sink.compression,
+        'compression_opts': sink.compression_opts,
+        'packed': sink.packed,
+        'quantize': sink.quantize,
+        'quantize_band': sink.quantize_band,
+        'active': sink.active,
+        }
+
+
+
+# Largest size of the models stored in memory for checkpoints
+CHECKPOINT_MODELS_MB = 256
+
+
+def _save_checkpoint(filename, state):
+    
+    """
+    
+    Write a checkpoint to a temporary file first, so a crash never leaves a partial checkpoint.
+
+    """
+    
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    os.replace(tmp, filename)
+
+
+
+# Process pool helpers for multiple chains
+_worker = {}
+
+
+def _init_chain_worker(sampler):
+    
+    """
+    
+    Keep the sampler once per worker process.
+
+    """
+    
+    _worker['sampler'] = sampler
+
+
+
+def _seed_worker(stream):
+    
+    """
+    
+    Seed the NumPy and random generators of a worker from its own random stream.
+
+    """
+    
+    np.random.seed(stream.generate_state(4))
+    random.seed(int(stream.generate_state(1)[0]))
+
+
+
+def _run_chain(model_initial, stream, sink, options):
+    
+    """
+    
+    Run a single chain in a worker process with its own random stream.
+
+    """
+    
+    _seed_worker(stream)
+    
+    sampler = _worker['sampler']
+    sampler.model = [model_initial]
+    
+    return sampler.mcmc_sampling_single_chain(progress=False, sink=sink, **options)
+
+
+
+class _ReplicaExchange(object):
+    """
+    
+    Exchange of the replica state with the main process, see mcmc_sampling_parallel_tempering.
+    
+    """
+    
+    
+    def __init__ (self, conn, interval):
+        
+        self.conn = conn
+        self.interval = interval
+    
+    
+    def __call__(self, model_sign_dist, loss_total, loss_individual):
+        
+        self.conn.send(('ok', loss_total))
+        
+        # Keep the state
+        if not self.conn.recv():
+            return model_sign_dist, loss_total, loss_individual
+        
+        # Swap the state with the neighbouring replica
+        self.conn.send(('ok', (model_sign_dist, loss_total, loss_individual)))
+        
+        return self.conn.recv()
+
+
+
+def _run_replica(conn, sampler, model_initial, stream, sink, options, swap_interval):
+    
+    """
+    
+    Run one replica of parallel tempering in its own process.
+
+    """
+    
+    try:
+        _init_chain_worker(sampler)
+        _seed_worker(stream)
+        
+        sampler = _worker['sampler']
+        sampler.model = [model_initial]
+        
+        outputs = sampler.mcmc_sampling_single_chain(
+            progress = False, 
+            sink = sink, 
+            exchange = _ReplicaExchange(conn, swap_interval), 
+            **options
+            )
+        
+        conn.send(('ok', outputs))
+    
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    
+    finally:
+        conn.close()
+
+
+
+def _receive(conn):
+    
+    """
+    
+    Receive a message of a replica, errors of the replica are raised in the main process.
+
+    """
+    
+    status, message = conn.recv()
+    
+    if status == 'error':
+        raise RuntimeError("A parallel tempering replica failed:\n" + message)
+    
+    return message
+
+
+
+class _SharedStopping(object):
+    """
+    
+    Trace of a chain in shared memory, the main process decides when the chains stop.
+    See mcmc_sampling_multi_chain.
+    
+    """
+    
+    
+    def __init__ (self, trace_name, control_name, chain, n_chain, iter_num, n_summary):
+        
+        self.trace_name = trace_name
+        self.control_name = control_name
+        self.chain = chain
+        self.n_chain = n_chain
+        self.shape = (n_chain, iter_num, n_summary)
+        
+        self.blocks = []
+    
+    
+    def allocate(self, iter_num, n_summary, burn_in = 0):
+        
+        self.blocks = [
+            shared_memory.SharedMemory(name=self.trace_name), 
+            shared_memory.SharedMemory(name=self.control_name),
+            ]
+        
+        self.trace = np.ndarray(self.shape, buffer=self.blocks[0].buf)
+        self.control = np.ndarray(self.n_chain+1, dtype=np.int64, buffer=self.blocks[1].buf)
+        
+        return self.trace[self.chain]
+    
+    
+    def update(self, trace, n):
+        
+        self.control[self.chain] = n
+        
+        return n >= self.control[-1]
+    
+    
+    def __getstate__(self):
+        
+        state = self.__dict__.copy()
+        state['blocks'] = []
+        state.pop('trace', None)
+        state.pop('control', None)
+        
+        return state
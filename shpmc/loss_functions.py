@@ -180,7 +180,7 @@ def loss_ordinary_procrustes_analysis(shape_reference, shape_comparision, contri
 
 
 
-def find_sketch_cross_section(self, model, ind_, direction):
+def find_sketch_cross_section(model, ind_, direction):
     
     """
     
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import copy
+from scipy import ndimage
+from shpmc.geo_stats import GaussianField, SpectralGaussianField
+
+
+
+def coarse_shape(shape, factor):
+    """
+
+    Shape of a grid coarsened by 'factor' cells along every axis, partial blocks at the end included
+
+    """
+
+    return tuple(-(-n // factor) for n in shape)
+
+
+
+def block_mean(array, factor):
+    """
+
+    Mean of the blocks of 'factor' cells along every axis.
+
+    Partial blocks at the end of an axis are averaged over their cells, and
+    NaN cells (e.g., inactive cells) are ignored; a block of NaN cells only
+    is NaN.
+
+    Parameters
+    ----------
+    array : array
+        values on the fine grid
+    factor : int
+        coarsening factor
+
+    Returns
+    -------
+    array
+        values on the coarse grid, see coarse_shape
+
+    """
+
+    array = np.asarray(array, dtype=float)
+    shape = coarse_shape(array.shape, factor)
+
+    valid = ~np.isnan(array)
+    padding = [(0, n * factor - m) for n, m in zip(shape, array.shape)]
+
+    blocks = (ele for n in shape for ele in (n, factor))
+    axes = tuple(range(1, 2 * array.ndim, 2))
+
+    total = np.pad(np.where(valid, array, 0), padding).reshape(*blocks).sum(axes)
+
+    blocks = (ele for n in shape for ele in (n, factor))
+    count = np.pad(valid, padding).reshape(*blocks).sum(axes)
+
+    return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+
+def coarsen_model(model, factor):
+    """
+
+    Level set function on the coarse grid.
+
+    Parameters
+    ----------
+    model : array
+        level set function or signed distance on the fine grid
+    factor : int
+        coarsening factor
+
+    Returns
+    -------
+    array
+        block mean of the model in units of coarse cells
+
+    """
+
+    return block_mean(model, factor) / factor
+
+
+
+def prolong_model(model, shape, factor):
+    """
+
+    Level set function on the fine grid, linearly interpolated from the coarse grid.
+
+    Parameters
+    ----------
+    model : array
+        level set function or signed distance on the coarse grid, NaN cells are
+        filled with their nearest valid value before the interpolation
+    shape : tuple
+        shape of the fine grid
+    factor : int
+        refinement factor
+
+    Returns
+    -------
+    array
+        model at the fine cell centres in units of fine cells
+
+    """
+
+    model = np.asarray(model, dtype=float)
+
+    invalid = np.isnan(model)
+    if invalid.any():
+        index = ndimage.distance_transform_edt(invalid, return_distances=False, return_indices=True)
+        model = model[tuple(index)]
+
+    # Fine cell centres in coarse cell indices
+    coords = [(np.arange(n) + 0.5) / factor - 0.5 for n in shape]
+    coords = np.meshgrid(*coords, indexing='ij')
+
+    return ndimage.map_coordinates(model, coords, order=1, mode='nearest') * factor
+
+
+
+def coarsen_active(active, factor):
+    """
+
+    Active cells of the coarse grid, i.e., the blocks with at least half of their cells active
+
+    """
+
+    return block_mean(np.asarray(active, dtype=float), factor) >= 0.5
+
+
+
+def coarsen_field(gaussian_field, factor, active = None):
+    """
+
+    Gaussian field of the coarse grid.
+
+    The ranges of the field are in the units of the cell centres, so the
+    same field parameters apply on the coarse grid; only the cell centres
+    are coarsened. Regular centres stay regular, i.e., the coarse centres
+    are origin + (i + 0.5) * factor * dx, including the partial block at the
+    end of an axis. Irregular centres are block-meaned, in which case a
+    SpectralGaussianField falls back to the gstools GaussianField. A
+    PrefetchField is replaced by the field it wraps.
+
+    Parameters
+    ----------
+    gaussian_field : GaussianField
+        field of the fine grid
+    factor : int
+        coarsening factor
+    active : array, default: None
+        active cells of the coarse grid, see coarsen_active
+
+    Returns
+    -------
+    GaussianField
+        copy of the field on the coarse cell centres
+
+    """
+
+    gaussian_field = getattr(gaussian_field, 'gaussian_field', gaussian_field)
+
+    # The wavenumber grids and buffers are dropped by __getstate__
+    coarse = copy.copy(gaussian_field)
+
+    regular = True
+    for key in ('x', 'y', 'z'):
+        centres = getattr(coarse, key)
+        if centres is None:
+            continue
+
+        centres = np.asarray(centres, dtype=float)
+        dx = np.diff(centres)
+
+        if len(dx) > 0 and np.allclose(dx, dx[0]):
+            n = coarse_shape(centres.shape, factor)[0]
+            centres = centres[0] - 0.5 * dx[0] + (np.arange(n) + 0.5) * factor * dx[0]
+        elif len(dx) > 0:
+            centres = block_mean(centres, factor)
+            regular = False
+
+        setattr(coarse, key, centres)
+
+    if not regular and isinstance(coarse, SpectralGaussianField):
+        coarse = GaussianField(
+            coarse.mean, coarse.variance,
+            coarse.range_x, coarse.range_y, coarse.range_z,
+            coarse.anisotropy_xy, coarse.anisotropy_xz,
+            coarse.x, coarse.y, coarse.z,
+            random = coarse.random,
+            output_params = coarse.output,
+            dtype = coarse.dtype,
+            )
+
+    coarse.active = active
+    coarse._positions = None
+
+    return coarse
+
+
+
+def coarsen_mesh(mesh, factor):
+    """
+
+    Coarse TensorMesh, e.g., to visualize the models of a coarse level.
+
+    Parameters
+    ----------
+    mesh : discretize.TensorMesh
+        mesh of the fine grid
+    factor : int
+        coarsening factor
+
+    Returns
+    -------
+    discretize.TensorMesh
+        mesh with the cell widths summed over the blocks and the same origin
+
+    """
+
+    from discretize import TensorMesh
+
+    h = [
+        np.add.reduceat(ele, np.arange(0, len(ele), factor))
+        for ele in mesh.h
+        ]
+
+    return TensorMesh(h, origin=mesh.origin)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+
+
+class StageTimer(object):
+    """
+
+    Lap timer of the stages of the sampling iterations.
+
+    Each lap costs one time.perf_counter call and a dictionary update, so
+    the timer is always on in the samplers. The time since the previous lap
+    is assigned to the named stage, e.g., 'velocity_field', 'distance' or
+    'loss_0', and the laps of an iteration are added to the totals when the
+    iteration ends.
+
+    """
+
+
+    def __init__ (self):
+
+        self.n = 0
+        self.total = {}
+        self.iteration = {}
+
+        self._last = time.perf_counter()
+
+
+    def start(self):
+        """
+
+        Start the laps of a new iteration.
+
+        """
+
+        self.iteration = {}
+        self._last = time.perf_counter()
+
+
+    def lap(self, stage):
+        """
+
+        Assign the time since the previous lap to a stage.
+
+        Parameters
+        ----------
+        stage : str
+            name of the stage
+
+        """
+
+        now = time.perf_counter()
+        self.iteration[stage] = self.iteration.get(stage, 0.) + now - self._last
+        self._last = now
+
+
+    def move(self, stage, target, value):
+        """
+
+        Move part of the time of a stage in this iteration to another stage,
+        e.g., the time a stage spent waiting on a background thread.
+
+        Parameters
+        ----------
+        stage : str
+            name of the stage
+        target : str
+            name of the stage receiving the time
+        value : float
+            time moved (s), at most the time of the stage
+
+        """
+
+        value = min(value, self.iteration.get(stage, 0.))
+        self.iteration[stage] = self.iteration.get(stage, 0.) - value
+        self.iteration[target] = self.iteration.get(target, 0.) + value
+
+
+    def end(self):
+        """
+
+        End the iteration and add its laps to the totals.
+
+        Returns
+        -------
+        dict
+            time of each stage in this iteration (s)
+
+        """
+
+        self.n += 1
+
+        for stage, value in self.iteration.items():
+            self.total[stage] = self.total.get(stage, 0.) + value
+
+        return self.iteration
+
+
+    def mean(self):
+        """
+
+        Mean time of each stage per iteration (s)
+
+        """
+
+        return {stage: value / max(self.n, 1) for stage, value in self.total.items()}
+
+
+    def postfix(self):
+        """
+
+        Mean time of each stage per iteration in ms, e.g., for the tqdm postfix
+
+        """
+
+        return {stage: '{:.1f}ms'.format(1e3 * value) for stage, value in self.mean().items()}
+
+
+    def summary(self):
+        """
+
+        Total and mean time of each stage and its fraction of the iteration time
+
+        """
+
+        total = sum(self.total.values())
+
+        return {
+            stage: {
+                'total': value,
+                'mean': value / max(self.n, 1),
+                'fraction': value / total if total > 0 else 0.,
+                }
+            for stage, value in self.total.items()
+            }
+
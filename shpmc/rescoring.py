@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from tqdm import tqdm
+from shpmc.constraints import BinaryConstraint, compile_constraints
+
+
+
+def rescore_samples(models, data, contribution = None, chunk_size = 100, progress = False, active = None):
+
+    """
+
+    Loss values of stored samples for each data set, computed in batches.
+
+    The loss functions are linear in the contributions, so the values for unit
+    contributions (the default) can be combined with any contribution vector
+    afterwards, e.g., loss_individual @ contribution.
+
+    Parameters
+    ----------
+    models : array or h5py dataset
+        stored signed distance models, dim: n by model shape, e.g., the 'model_dist' dataset
+    data : list
+        data sets as passed to StochasticLevelSet3D
+    contribution : list, default: None
+        contribution of each data set, ones if None
+    chunk_size : int, default: 100
+        number of models read and scored at once
+    progress : bool, default: False
+        show the tqdm progress bar
+    active : array, default: None
+        active cells passed to the sampler, the observations in inactive cells
+        are dropped as in StochasticLevelSet3D
+
+    Returns
+    -------
+    loss_individual : array
+        loss values of each model (row) and data set (column)
+
+    """
+
+    constraints = compile_constraints(data)
+
+    if active is not None:
+        active = np.asarray(active, dtype=bool)
+        constraints = [ele.restrict(active) if isinstance(ele, BinaryConstraint) else ele for ele in constraints]
+
+    if contribution is None:
+        contribution = np.ones(len(constraints))
+
+    n = len(models)
+    loss_individual = np.zeros((n, len(constraints)))
+
+    for start in tqdm(range(0, n, chunk_size), disable = not progress):
+
+        chunk = np.asarray(models[start:start+chunk_size])
+
+        for count, ele in enumerate(constraints):
+            loss_individual[start:start+len(chunk), count] = ele.batch_loss(chunk, contribution[count])
+
+    return loss_individual
+
+
+
+def importance_weights(
+        loss_individual,
+        contribution_old,
+        contribution_new,
+        temperature_old = 1,
+        temperature_new = 1,
+        multiplicity = None,
+        ):
+
+    """
+
+    Importance weights to reweight a chain to new contributions or temperatures.
+
+    The chain samples exp(-loss**2 / temperature), where loss is the sum of
+    the contributions times the loss values of each data set.
+
+    Parameters
+    ----------
+    loss_individual : array
+        loss values for unit contributions, see rescore_samples
+    contribution_old : list
+        contributions used to run the chain
+    contribution_new : list
+        contributions of the new target
+    temperature_old : float, default: 1
+        temperature used to run the chain
+    temperature_new : float, default: 1
+        temperature of the new target
+    multiplicity : array, default: None
+        number of kept iterations of each sample of a run-length chain, see read_multiplicity
+
+    Returns
+    -------
+    weights : array
+        normalized importance weights of the samples
+    ess : float
+        effective sample size of the weights
+
+    """
+
+    loss_old = loss_individual @ np.asarray(contribution_old, dtype=float)
+    loss_new = loss_individual @ np.asarray(contribution_new, dtype=float)
+
+    log_weights = loss_old**2 / temperature_old - loss_new**2 / temperature_new
+    log_weights[np.isnan(log_weights)] = -np.inf
+
+    weights = np.exp(log_weights - np.max(log_weights))
+    if multiplicity is not None:
+        weights *= multiplicity
+    weights /= weights.sum()
+
+    ess = 1 / np.sum(weights**2)
+
+    return weights, ess
+
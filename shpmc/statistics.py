@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+
+class PosteriorStatistics(object):
+    """
+
+    Running posterior statistics of the sampled models.
+
+    Every update costs O(cells): the indicator (m >= 0) counts give the
+    probability of the target, and Welford's algorithm gives the mean and
+    variance of the signed distance and of the individual loss values.
+
+    With an active-cell mask, the running sums are kept for the active
+    cells only (in C order) and the maps are NaN in the inactive cells.
+
+    """
+
+
+    def __init__ (self, shape, nd, active = None):
+
+        """
+
+        Parameters
+        ----------
+        shape : tuple
+            shape of the model
+        nd : int
+            number of data sets
+        active : array, default: None
+            boolean mask of the active cells, all cells if None
+
+        """
+
+        self.shape = tuple(shape)
+        self.nd = nd
+        self.active = None if active is None else np.asarray(active, dtype=bool)
+
+        self.n = 0
+
+        self.indicator_count = np.zeros(self.cells)
+        self._mean = np.zeros(self.cells)
+        self.m2 = np.zeros(self.cells)
+
+        self.loss_mean = np.zeros(nd)
+        self.loss_m2 = np.zeros(nd)
+
+        # Workspace buffers
+        self._delta = np.zeros(self.cells)
+        self._indicator = np.zeros(self.cells, dtype=bool)
+
+
+    @property
+    def cells(self):
+        """
+
+        Shape of the running sums, i.e., the model shape or the number of active cells
+
+        """
+
+        if self.active is None:
+            return self.shape
+
+        return (int(np.count_nonzero(self.active)),)
+
+
+    def _grid(self, values):
+        """
+
+        Map of the values of the active cells on the model grid, NaN in the inactive cells
+
+        """
+
+        if self.active is None:
+            return values
+
+        grid = np.full(self.shape, np.nan)
+        grid[self.active] = values
+
+        return grid
+
+
+    def update(self, model_sign_dist, loss_individual, weight = 1):
+        """
+
+        Add one sample.
+
+        Parameters
+        ----------
+        model_sign_dist : array
+            signed distance of the sampled model
+        loss_individual : array
+            loss values for each data set
+        weight : int, default: 1
+            number of times the sample is counted, e.g., the multiplicity of a run-length chain
+
+        """
+
+        self.n += weight
+
+        if self.active is not None:
+            model_sign_dist = model_sign_dist[self.active]
+
+        # Indicator
+        np.greater_equal(model_sign_dist, 0, out=self._indicator)
+        if weight == 1:
+            self.indicator_count += self._indicator
+        else:
+            self.indicator_count += weight * self._indicator
+
+        # Signed distance (weighted Welford update)
+        np.subtract(model_sign_dist, self._mean, out=self._delta)
+        self._mean += self._delta / (self.n / weight)
+        self._delta *= model_sign_dist - self._mean
+        if weight != 1:
+            self._delta *= weight
+        self.m2 += self._delta
+
+        # Loss values
+        delta = loss_individual - self.loss_mean
+        self.loss_mean += delta / (self.n / weight)
+        self.loss_m2 += weight * delta * (loss_individual - self.loss_mean)
+
+
+    def merge(self, other):
+        """
+
+        Merge the statistics of another chain (Chan et al. parallel algorithm).
+
+        Parameters
+        ----------
+        other : PosteriorStatistics
+            statistics of another chain with the same model shape and active cells
+
+        Returns
+        -------
+        PosteriorStatistics
+            the combined statistics
+
+        """
+
+        merged = PosteriorStatistics(self.shape, self.nd, self.active)
+        merged.n = self.n + other.n
+
+        if merged.n == 0:
+            return merged
+
+        w = other.n / merged.n
+
+        merged.indicator_count = self.indicator_count + other.indicator_count
+
+        delta = other._mean - self._mean
+        merged._mean = self._mean + delta * w
+        merged.m2 = self.m2 + other.m2 + delta**2 * self.n * w
+
+        delta = other.loss_mean - self.loss_mean
+        merged.loss_mean = self.loss_mean + delta * w
+        merged.loss_m2 = self.loss_m2 + other.loss_m2 + delta**2 * self.n * w
+
+        return merged
+
+
+    @property
+    def probability(self):
+        """
+
+        Probability of each cell belonging to the target, i.e., the mean of the indicator models
+
+        """
+
+        return self._grid(self.indicator_count / max(self.n, 1))
+
+
+    @property
+    def indicator_std(self):
+        """
+
+        Standard deviation of the indicator models
+
+        """
+
+        p = self.probability
+
+        return np.sqrt(p * (1 - p))
+
+
+    @property
+    def mean(self):
+        """
+
+        Mean of the signed distance
+
+        """
+
+        return self._grid(self._mean)
+
+
+    @property
+    def std(self):
+        """
+
+        Standard deviation of the signed distance
+
+        """
+
+        return self._grid(np.sqrt(self.m2 / max(self.n, 1)))
+
+
+    @property
+    def loss_std(self):
+        """
+
+        Standard deviation of the loss values for each data set
+
+        """
+
+        return np.sqrt(self.loss_m2 / max(self.n, 1))
+
+
+    def to_dict(self):
+        """
+
+        Posterior maps as a dictionary, e.g., to be saved in HDF5
+
+        """
+
+        return {
+            'n_samples': self.n,
+            'probability': self.probability,
+            'indicator_std': self.indicator_std,
+            'mean': self.mean,
+            'std': self.std,
+            'loss_mean': self.loss_mean,
+            'loss_std': self.loss_std,
+            }
+
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state['_delta'], state['_indicator']
+
+        return state
+
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._delta = np.zeros(self.cells)
+        self._indicator = np.zeros(self.cells, dtype=bool)
@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import queue
+import threading
+import h5py
+
+
+
+def write_datasets(filename, mode = 'a', **datasets):
+    """
+
+    Write datasets to an HDF5 file, replacing existing datasets of the same name.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 file
+    mode : str, default: 'a'
+        file mode, 'a' adds to an existing file and 'w' overwrites it
+    **datasets : array
+        datasets to write, e.g., loss and acceptance
+
+    """
+
+    with h5py.File(filename, mode) as hf:
+        for key, value in datasets.items():
+            if key in hf:
+                del hf[key]
+            hf.create_dataset(key, data = value)
+
+
+
+class HDF5SampleWriter(object):
+    """
+
+    Stream sampled models to a chunked and compressed HDF5 dataset.
+
+    Samples are handed to a background thread through a bounded queue, so
+    the sampler only waits on the disk when the writer falls 'queue_size'
+    samples behind. The file layout matches the outputs of the examples,
+    i.e., 'model_dist', 'loss' and 'acceptance'.
+
+    In the packed mode, only the indicator (m >= 0) of each sample is kept
+    as an np.packbits bitmask ('model_indicator', C order), optionally with
+    the signed distance clipped to a narrow band and quantized to int8 or
+    int16 ('model_dist_quantized'). The samples are encoded in the writer
+    thread; read them back in chunks with read_indicators and read_models.
+
+    With an active-cell mask, only the active cells of each sample are
+    stored (in C order) and the mask is written to the 'active' dataset.
+
+    """
+
+
+    def __init__ (
+            self,
+            filename,
+            dataset = 'model_dist',
+            chunk_size = 1,
+            compression = 'gzip',
+            compression_opts = 4,
+            queue_size = 16,
+            resume = None,
+            packed = False,
+            quantize = None,
+            quantize_band = 8.,
+            active = None,
+            ):
+
+        """
+
+        Parameters
+        ----------
+        filename : str
+            output HDF5 file, overwritten if it exists
+        dataset : str, default: 'model_dist'
+            name of the dataset holding the samples
+        chunk_size : int, default: 1
+            number of samples per HDF5 chunk
+        compression : str, default: 'gzip'
+            HDF5 compression filter, None for no compression
+        compression_opts : int, default: 4
+            compression level
+        queue_size : int, default: 16
+            maximum number of samples waiting to be written
+        resume : int, default: None
+            continue an existing file from this number of samples, later samples 
+            (e.g., written after the last checkpoint) are discarded
+        packed : bool, default: False
+            store the bit-packed indicators instead of the signed distances
+        quantize : str, default: None
+            also store the signed distance quantized to 'int8' or 'int16' in packed mode
+        quantize_band : float, default: 8.
+            half width of the quantized band, the signed distance is clipped to +/- quantize_band
+        active : array, default: None
+            boolean mask of the active cells, only they are stored
+
+        """
+
+        self.filename = filename
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_opts = compression_opts if compression is not None else None
+
+        assert quantize in (None, 'int8', 'int16'), "'quantize' must be None, 'int8' or 'int16'!"
+        assert quantize is None or packed, "Quantized signed distances are stored in packed mode only!"
+
+        self.packed = packed
+        self.quantize = quantize
+        self.quantize_band = quantize_band
+        self.active = None if active is None else np.asarray(active, dtype=bool)
+
+        self.resume = resume
+        self.count = 0
+
+        # Cut the existing samples back to the resumed count
+        if resume is not None:
+            with h5py.File(filename, 'a') as hf:
+                for key in self.datasets:
+                    if key in hf:
+                        hf[key].resize(resume, axis=0)
+            self.count = resume
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._error = None
+
+
+    @property
+    def datasets(self):
+        """
+
+        Names of the datasets holding the samples
+
+        """
+
+        if not self.packed:
+            return [self.dataset]
+
+        if self.quantize is None:
+            return ['model_indicator']
+
+        return ['model_indicator', 'model_dist_quantized']
+
+
+    def _encoders(self, shape, dtype):
+        """
+
+        Dataset name, encoding function, sample shape, type and attributes of each stored dataset
+
+        """
+
+        if not self.packed:
+            return [(self.dataset, None, shape, dtype, {})]
+
+        n_cell = int(np.prod(shape))
+
+        pack = lambda model: np.packbits(np.ravel(model) >= 0)
+        encoders = [('model_indicator', pack, ((n_cell + 7) // 8,), np.uint8, {})]
+
+        if self.quantize is not None:
+
+            q_max = np.iinfo(self.quantize).max
+            scale = self.quantize_band / q_max
+
+            def quantize(model):
+                q = np.clip(model, -self.quantize_band, self.quantize_band) / scale
+                return np.rint(q).astype(self.quantize)
+
+            encoders.append(('model_dist_quantized', quantize, shape, np.dtype(self.quantize), {'scale': scale, 'band': self.quantize_band}))
+
+        return encoders
+
+
+    def append(self, model):
+        """
+
+        Queue one sample for writing.
+
+        Parameters
+        ----------
+        model : array
+            sampled model, the shape and dtype are fixed by the first sample
+
+        """
+
+        self._raise_error()
+
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target = self._write,
+                args = (model.shape, model.dtype),
+                daemon = True
+                )
+            self._thread.start()
+
+        self._queue.put(model)
+        self.count += 1
+
+
+    def flush(self):
+        """
+
+        Wait until the queued samples are written and flushed to disk, e.g., before a checkpoint.
+
+        """
+
+        if self._thread is not None:
+            flushed = threading.Event()
+            self._queue.put(flushed)
+
+            while not flushed.wait(0.1):
+                self._raise_error()
+
+        self._raise_error()
+
+
+    def close(self, **datasets):
+        """
+
+        Flush the queued samples, write additional datasets and close the file.
+
+        Parameters
+        ----------
+        **datasets : array
+            extra datasets written next to the samples, e.g., loss and acceptance
+
+        """
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        self._raise_error()
+
+        write_datasets(self.filename, mode = 'a' if self.count > 0 or self.resume is not None else 'w', **datasets)
+
+
+    def _write(self, shape, dtype):
+        """
+
+        Writer thread, appends one chunk of samples at a time.
+
+        """
+
+        done = False
+
+        try:
+
+            with h5py.File(self.filename, 'w' if self.resume is None else 'a') as hf:
+
+                # Only the active cells are stored
+                cells = shape
+                if self.active is not None:
+                    cells = (int(np.count_nonzero(self.active)),)
+                    if 'active' not in hf:
+                        hf.create_dataset('active', data = self.active)
+
+                dsets, buffers = [], []
+
+                for key, encode, shape_i, dtype_i, attrs in self._encoders(cells, dtype):
+
+                    if self.resume is not None and key in hf:
+                        dset = hf[key]
+                    else:
+                        dset = hf.create_dataset(
+                            key,
+                            shape = (0, *shape_i),
+                            maxshape = (None, *shape_i),
+                            dtype = dtype_i,
+                            chunks = (self.chunk_size, *shape_i),
+                            compression = self.compression,
+                            compression_opts = self.compression_opts,
+                            shuffle = self.compression is not None,
+                            )
+                        dset.attrs.update(attrs)
+                        dset.attrs['shape'] = shape
+
+                    dsets.append((dset, encode))
+                    buffers.append(np.zeros((self.chunk_size, *shape_i), dtype=dtype_i))
+
+                n = 0
+
+                while not done:
+
+                    model = self._queue.get()
+                    done = model is None
+                    flush = isinstance(model, threading.Event)
+
+                    if done or flush or n == self.chunk_size:
+                        if n > 0:
+                            for (dset, _), buffer in zip(dsets, buffers):
+                                dset.resize(dset.shape[0] + n, axis=0)
+                                dset[-n:] = buffer[:n]
+                            n = 0
+
+                    if done:
+                        break
+
+                    if flush:
+                        hf.flush()
+                        model.set()
+                        continue
+
+                    if self.active is not None:
+                        model = model[self.active]
+
+                    for (_, encode), buffer in zip(dsets, buffers):
+                        buffer[n] = model if encode is None else encode(model)
+                    n += 1
+
+        except Exception as err:
+            self._error = err
+
+            # Keep draining so the sampler never blocks on a dead writer
+            while not done:
+                done = self._queue.get() is None
+
+
+    def _raise_error(self):
+
+        if self._error is not None:
+            raise RuntimeError("Writing samples to '{}' failed!".format(self.filename)) from self._error
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        if self._thread is not None:
+            self.close()
+
+
+
+def read_indicators(filename, start = 0, stop = None, chunk_size = 100, dataset = 'model_dist'):
+    """
+
+    Read the indicator models (m >= 0) of a sample file in chunks.
+
+    Both layouts of HDF5SampleWriter are understood: the bit-packed
+    'model_indicator' dataset is unpacked, otherwise the indicators are
+    computed from the signed distance in 'dataset'. Samples of the active
+    cells only are mapped back to the model grid (False in inactive cells).
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 sample file
+    start : int, default: 0
+        first sample
+    stop : int, default: None
+        last sample (excluded), all samples if None
+    chunk_size : int, default: 100
+        number of samples read at once
+    dataset : str, default: 'model_dist'
+        signed distance dataset of unpacked files
+
+    Yields
+    ------
+    indicators : array
+        boolean indicator models of one chunk, dim: chunk by model shape
+
+    """
+
+    with h5py.File(filename, 'r') as hf:
+
+        packed = 'model_indicator' in hf
+        dset = hf['model_indicator'] if packed else hf[dataset]
+        active = hf['active'][()] if 'active' in hf else None
+
+        if packed:
+            shape = tuple(dset.attrs['shape'])
+            n_cell = int(np.prod(shape)) if active is None else int(np.count_nonzero(active))
+
+        stop = len(dset) if stop is None else min(stop, len(dset))
+
+        for ii in range(start, stop, chunk_size):
+
+            chunk = dset[ii:min(ii+chunk_size, stop)]
+
+            if packed:
+                chunk = np.unpackbits(chunk, axis=1, count=n_cell).astype(bool)
+            else:
+                chunk = chunk >= 0
+
+            if active is not None:
+                chunk = _expand(chunk, active, False)
+            elif packed:
+                chunk = chunk.reshape(len(chunk), *shape)
+
+            yield chunk
+
+
+
+def read_models(filename, start = 0, stop = None, chunk_size = 100, dataset = 'model_dist'):
+    """
+
+    Read the signed distance models of a sample file in chunks.
+
+    The quantized signed distance ('model_dist_quantized') is converted back
+    to float32; it is exact up to half a quantization step inside the band
+    and clipped to +/- band outside of it. Samples of the active cells only
+    are mapped back to the model grid (NaN in inactive cells).
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 sample file
+    start : int, default: 0
+        first sample
+    stop : int, default: None
+        last sample (excluded), all samples if None
+    chunk_size : int, default: 100
+        number of samples read at once
+    dataset : str, default: 'model_dist'
+        signed distance dataset of unpacked files
+
+    Yields
+    ------
+    models : array
+        signed distance models of one chunk, dim: chunk by model shape
+
+    """
+
+    with h5py.File(filename, 'r') as hf:
+
+        if 'model_dist_quantized' in hf:
+            dset = hf['model_dist_quantized']
+            scale = dset.attrs['scale']
+        elif dataset in hf:
+            dset = hf[dataset]
+            scale = None
+        else:
+            raise KeyError("'{}' only holds the bit-packed indicators, see read_indicators!".format(filename))
+
+        active = hf['active'][()] if 'active' in hf else None
+
+        stop = len(dset) if stop is None else min(stop, len(dset))
+
+        for ii in range(start, stop, chunk_size):
+
+            chunk = dset[ii:min(ii+chunk_size, stop)]
+
+            if scale is not None:
+                chunk = chunk.astype(np.float32) * np.float32(scale)
+
+            if active is not None:
+                chunk = _expand(chunk, active, np.nan)
+
+            yield chunk
+
+
+
+def read_multiplicity(filename, dataset = 'model_dist'):
+    """
+
+    Weights of the stored models of a sample file.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 sample file
+    dataset : str, default: 'model_dist'
+        signed distance dataset of unpacked files
+
+    Returns
+    -------
+    multiplicity : array
+        number of kept iterations of each stored model, i.e., the 'multiplicity' 
+        dataset of a run-length chain and ones otherwise
+
+    """
+
+    with h5py.File(filename, 'r') as hf:
+
+        if 'multiplicity' in hf:
+            return hf['multiplicity'][()]
+
+        dset = hf['model_indicator'] if 'model_indicator' in hf else hf[dataset]
+
+        return np.ones(len(dset), dtype=np.int64)
+
+
+
+def indicator_statistics(filename, start = 0, stop = None, chunk_size = 100, dataset = 'model_dist'):
+    """
+
+    Probability and standard deviation of the indicator models of a sample file.
+
+    The samples are read in chunks, so the memory use is independent of the
+    number of samples, e.g., for the probability maps of the examples. The
+    models of a run-length chain are weighted by their multiplicity.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 sample file
+    start, stop, chunk_size, dataset :
+        see read_indicators
+
+    Returns
+    -------
+    dict
+        'n_samples' (the total weight), 'probability' and 'indicator_std', as in PosteriorStatistics
+
+    """
+
+    multiplicity = read_multiplicity(filename, dataset)
+
+    n = 0
+    count = None
+    ii = start
+
+    for chunk in read_indicators(filename, start, stop, chunk_size, dataset):
+
+        if count is None:
+            count = np.zeros(chunk.shape[1:])
+
+        weights = multiplicity[ii:ii+len(chunk)]
+        ii += len(chunk)
+
+        count += np.tensordot(weights, chunk, 1)
+        n += int(weights.sum())
+
+    p = count / max(n, 1) if count is not None else None
+
+    return {
+        'n_samples': n,
+        'probability': p,
+        'indicator_std': np.sqrt(p * (1 - p)) if p is not None else None,
+        }
+
+
+
+def _expand(chunk, active, fill):
+    """
+
+    Samples of the active cells on the model grid, 'fill' in the inactive cells.
+
+    """
+
+    grid = np.full((len(chunk), *active.shape), fill, dtype=chunk.dtype)
+    grid[:, active] = chunk
+
+    return grid